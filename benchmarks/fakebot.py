@@ -0,0 +1,69 @@
+"""Recording stand-ins for the Telegram objects used by the handlers"""
+
+import threading
+import time
+
+
+class FakeBot:
+    """Records every message instead of calling the Telegram API"""
+
+    # read by CommandHandler and the Dispatcher
+    id = 1
+    username = 'nokycbot'
+    defaults = None
+
+    def __init__(self):
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def _record(self, kind, chat_id, **kwargs):
+        with self._lock:
+            self.sent.append((time.monotonic(), kind, chat_id, kwargs))
+
+    def send_message(self, chat_id, text=None, **kwargs):
+        self._record('message', chat_id, text=text, **kwargs)
+
+    def send_photo(self, chat_id, photo=None, **kwargs):
+        self._record('photo', chat_id, size=len(photo.getvalue()), **kwargs)
+
+    def answer_callback_query(self, callback_query_id, **kwargs):
+        self._record('answer', callback_query_id, **kwargs)
+
+    def edit_message_text(self, text=None, chat_id=None, **kwargs):
+        self._record('edit', chat_id, text=text, **kwargs)
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+
+
+class FakeCallbackQuery:
+    def __init__(self, bot, user_id, data):
+        self.bot = bot
+        self.from_user = FakeUser(user_id)
+        self.data = data
+
+    def answer(self, *args, **kwargs):
+        self.bot.answer_callback_query(self.from_user.id, **kwargs)
+
+    def edit_message_text(self, text=None, **kwargs):
+        self.bot.edit_message_text(text, chat_id=self.from_user.id, **kwargs)
+
+
+class FakeUpdate:
+    """Update carrying a callback query, as produced by an inline button"""
+
+    def __init__(self, bot, user_id, data):
+        self.callback_query = FakeCallbackQuery(bot, user_id, data)
+        self.message = None
+        self.effective_user = self.callback_query.from_user
+        self.effective_chat = self.callback_query.from_user
+
+
+class FakeContext:
+    def __init__(self, bot, user_data=None):
+        self.bot = bot
+        self.user_data = {} if user_data is None else user_data
+        self.bot_data = {}
+        self.args = []
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+"""Load test of the real Dispatcher with thousands of simulated users
+
+Registers the handlers of bot.main on a python-telegram-bot Dispatcher whose
+bot is a recording fake, points the adapters at the exchange stand-in and
+feeds it synthetic Updates: every user goes through /start and the menu
+buttons (action, exchange, currency, premium, format, query) with random
+think times. Each stage runs more users than the previous one and reports
+the time updates wait in the Dispatcher queue, the time spent in the
+handlers, the time until the query results are sent through the rate-limited
+outbox, queue depths and the first stage that misses the latency objective. Run from the repository root:
+
+    python3 -m benchmarks.load --users 100,500,1000,2000 --duration 20
+"""
+
+import argparse
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from queue import Queue
+
+import config as config
+from benchmarks.fakebot import FakeBot
+from benchmarks.run import percentile
+from benchmarks.standin import Fixtures, StandIn
+
+EXCHANGE_CHOICES = ['all', 'all', 'bisq', 'hodlhodl', 'robosats']
+PREMIUM_CHOICES = ['alloffers', 'alloffers', '-1', '-3', '1', '3']
+
+
+class UpdateFactory:
+    """Builds real telegram.Update objects bound to the fake bot"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._ids = itertools.count(1)
+
+    def _user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+
+    def _message(self, user_id, text):
+        return {'message_id': next(self._ids), 'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'}, 'from': self._user(user_id),
+                'text': text}
+
+    def command(self, user_id, text):
+        from telegram import Update
+        message = self._message(user_id, text)
+        message['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                'length': len(text.split()[0])}]
+        return Update.de_json({'update_id': next(self._ids), 'message': message}, self.bot)
+
+    def callback(self, user_id, data):
+        from telegram import Update
+        query = {'id': str(next(self._ids)), 'from': self._user(user_id),
+                 'chat_instance': str(user_id), 'data': data,
+                 'message': self._message(user_id, 'menu')}
+        return Update.de_json({'update_id': next(self._ids), 'callback_query': query}, self.bot)
+
+
+def user_flow():
+    """Steps of one user: ('command', text) or ('callback', data)"""
+    return [('command', '/start'),
+            ('callback', random.choice(['buy', 'sell'])),
+            ('callback', random.choice(EXCHANGE_CHOICES)),
+            ('callback', random.choice(['eur', 'eur', 'usd', 'gbp', 'chf', 'jpy', 'cny'])),
+            ('callback', random.choice(PREMIUM_CHOICES)),
+            ('callback', random.choice(['text', 'text', 'text', 'img'])),
+            ('callback', 'query')]
+
+
+class Probe:
+    """Timestamps of every update: queued, handler started, handler done"""
+
+    def __init__(self):
+        self.queued = {}
+        self.started = {}
+        self.done = {}
+        self.kinds = {}
+        self.queries = {}
+        self._lock = threading.Lock()
+
+    def enqueue(self, update, kind):
+        with self._lock:
+            self.queued[update.update_id] = time.monotonic()
+            self.kinds[update.update_id] = kind
+            if kind == 'query':
+                self.queries[update.callback_query.from_user.id] = time.monotonic()
+
+    def start(self, update, context):
+        self.started[update.update_id] = time.monotonic()
+
+    def finish(self, update, context):
+        self.done[update.update_id] = time.monotonic()
+
+
+def run_stage(dispatcher, factory, probe, bot, users, first_user, duration, think, timeout):
+    """Feed the updates of one stage and wait until they are handled
+
+    Returns:
+        dict: stage report
+    """
+    from utils import delivery, workers
+
+    events = []
+    order = itertools.count()
+    for user_id in range(first_user, first_user + users):
+        at = random.uniform(0, duration / 2)
+        for kind, value in user_flow():
+            heapq.heappush(events, (at, next(order), user_id, kind, value))
+            at += random.expovariate(1 / think) if think else 0
+    depths = []
+    running = threading.Event()
+    running.set()
+
+    def sample():
+        while running.is_set():
+            depths.append((dispatcher.update_queue.qsize(), workers.queries.pending(),
+                           delivery.outbox.pending()))
+            time.sleep(0.1)
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+
+    first_sent = len(bot.sent)
+    start = time.monotonic()
+    sent = []
+    while events:
+        at, _, user_id, kind, value = heapq.heappop(events)
+        delay = start + at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        if kind == 'command':
+            update = factory.command(user_id, value)
+        else:
+            update = factory.callback(user_id, value)
+        probe.enqueue(update, 'query' if value == 'query' else value if kind == 'command'
+                      else 'button')
+        dispatcher.update_queue.put(update)
+        sent.append(update.update_id)
+    feed_seconds = time.monotonic() - start
+    # still queued when the users stop: the outbox fell behind during the stage
+    outbox_end = delivery.outbox.pending()
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and not all(uid in probe.done for uid in sent):
+        time.sleep(0.05)
+    workers.queries.join(max(0.0, deadline - time.monotonic()))
+    delivery.outbox.join(max(0.0, deadline - time.monotonic()))
+    running.clear()
+    sampler.join()
+    elapsed = time.monotonic() - start
+
+    handled = [uid for uid in sent if uid in probe.done]
+    waits = [probe.started[uid] - probe.queued[uid] for uid in handled]
+    totals = [probe.done[uid] - probe.queued[uid] for uid in handled]
+    handler = {}
+    for uid in handled:
+        handler.setdefault(probe.kinds[uid], []).append(probe.done[uid] - probe.started[uid])
+
+    # first result message of every user after its query
+    results = []
+    busy = 0
+    import i18n
+    busy_text = i18n.t('menu.busy', locale='en')
+    answered = set()
+    for ts, kind, chat_id, kwargs in bot.sent[first_sent:]:
+        # the outbox may have merged several texts in one message
+        busy += (kwargs.get('text') or '').count(busy_text)
+        queried = probe.queries.get(chat_id)
+        if (queried is None or chat_id in answered or ts < queried
+                or not (kind == 'photo' or '```' in (kwargs.get('text') or ''))):
+            continue
+        answered.add(chat_id)
+        results.append(ts - queried)
+
+    return {'users': users, 'updates': len(sent), 'handled': len(handled),
+            'rate': len(sent) / feed_seconds if feed_seconds else 0.0,
+            'elapsed': elapsed,
+            'wait_p50': percentile(waits, 50) if waits else None,
+            'wait_p99': percentile(waits, 99) if waits else None,
+            'total_p99': percentile(totals, 99) if totals else None,
+            'handler_p99': {kind: percentile(values, 99) for kind, values in handler.items()},
+            'results': len(results),
+            'result_p50': percentile(results, 50) if results else None,
+            'result_p99': percentile(results, 99) if results else None,
+            'busy': busy,
+            'max_queue': max((sample[0] for sample in depths), default=0),
+            'max_pending': max((sample[1] for sample in depths), default=0),
+            'max_outbox': max((sample[2] for sample in depths), default=0),
+            'outbox_end': outbox_end}
+
+
+def ms(seconds):
+    return '-' if seconds is None else f"{seconds * 1000:.1f}"
+
+
+def print_report(stages, slo, send_rate):
+    print(f"{'users':>6} {'updates':>8} {'upd/s':>7} {'wait p50':>9} {'wait p99':>9} "
+          f"{'e2e p99':>9} {'result p50':>11} {'result p99':>11} {'queue':>6} "
+          f"{'pending':>8} {'outbox':>7} {'busy':>5} {'lost':>5}")
+    for s in stages:
+        print(f"{s['users']:6d} {s['updates']:8d} {s['rate']:7.0f} {ms(s['wait_p50']):>9} "
+              f"{ms(s['wait_p99']):>9} {ms(s['total_p99']):>9} {ms(s['result_p50']):>11} "
+              f"{ms(s['result_p99']):>11} {s['max_queue']:6d} {s['max_pending']:8d} "
+              f"{s['max_outbox']:7d} "
+              f"{s['busy']:5d} {s['updates'] - s['handled']:5d}")
+    print("\nhandler p99 ms: " + ', '.join(
+        f"{kind} {ms(seconds)}" for kind, seconds in sorted(stages[-1]['handler_p99'].items())))
+    saturated = next((s for s in stages if saturated_stage(s, slo, send_rate)), None)
+    if saturated is None:
+        print(f"not saturated: every stage kept the update and result p99 under "
+              f"{slo * 1000:.0f} ms, and the outbox kept up")
+    else:
+        print(f"saturation: {saturated['users']} users ({saturated['rate']:.0f} updates/s)")
+
+
+def saturated_stage(stage, slo, send_rate):
+    """Whether a stage missed the objective
+
+    Besides lost, rejected or slow updates, a stage is saturated when its
+    results took longer than slo, or when the outbox backlog left at the end
+    of the stage takes longer than slo to send at send_rate messages/s
+    (None for no flood limit).
+    """
+    backlog = send_rate is not None and stage['outbox_end'] > send_rate * slo
+    return (stage['handled'] < stage['updates'] or stage['busy'] > 0
+            or (stage['total_p99'] or 0) > slo or (stage['result_p99'] or 0) > slo
+            or backlog)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', default='100,500,1000,2000',
+                        help='comma separated users of every stage')
+    parser.add_argument('--duration', type=float, default=20,
+                        help='seconds over which the users of a stage arrive')
+    parser.add_argument('--think', type=float, default=1.0,
+                        help='mean seconds between the steps of a user')
+    parser.add_argument('--slo', type=float, default=1.0,
+                        help='p99 seconds from update to handled, and from query to result, '
+                        'before a stage is saturated')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='seconds to wait for a stage to drain')
+    parser.add_argument('--depth', type=int, default=200,
+                        help='synthetic offers per side and exchange')
+    parser.add_argument('--latency', type=float, default=0.5,
+                        help='seconds added to every stand-in answer')
+    parser.add_argument('--jitter', type=float, default=0.5)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-send-limits', action='store_true',
+                        help='do not apply the Telegram flood limits of the outbox')
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+    random.seed(args.seed)
+
+    standin = StandIn(Fixtures(args.depth), args.latency, args.jitter, args.error_rate).start()
+    standin.configure(config)
+    if args.no_send_limits:
+        config.SEND_GLOBAL_RATE = config.SEND_CHAT_RATE = None
+
+    from telegram import Update
+    from telegram.ext import Dispatcher, TypeHandler
+    import bot as bot_module
+    from utils import utils
+
+    bot = FakeBot()
+    dispatcher = Dispatcher(bot, Queue(), use_context=True)
+    probe = Probe()
+    dispatcher.add_handler(TypeHandler(Update, probe.start), group=-1)
+    bot_module.register_handlers(dispatcher)
+    dispatcher.add_handler(TypeHandler(Update, probe.finish), group=1)
+    threading.Thread(target=dispatcher.start, daemon=True, name='dispatcher').start()
+
+    # what the refresh_books job does in production
+    stop = threading.Event()
+
+    def refresh():
+        while not stop.is_set():
+            utils.refresh_orders(bot_module.CURRENCIES)
+            stop.wait(config.CACHE_REFRESH_INTERVAL)
+    threading.Thread(target=refresh, daemon=True, name='refresh').start()
+    while not utils.cache.books.get(('bisq', 'eur')) and standin.requests < 1000:
+        time.sleep(0.1)
+
+    factory = UpdateFactory(bot)
+    stages = []
+    first_user = 1
+    for users in [int(value) for value in args.users.split(',')]:
+        stages.append(run_stage(dispatcher, factory, probe, bot, users, first_user,
+                                args.duration, args.think, args.timeout))
+        first_user += users
+
+    print(f"depth={args.depth} latency={args.latency}s jitter={args.jitter}s "
+          f"workers={config.QUERY_WORKERS} queue={config.QUERY_QUEUE_SIZE} "
+          f"upstream requests={standin.requests}")
+    print_report(stages, args.slo, config.SEND_GLOBAL_RATE)
+    stop.set()
+    dispatcher.stop()
+    standin.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+"""Offline end-to-end benchmarks of the query path
+
+Starts the exchange stand-in, points the adapters at it and measures
+print_orders (cold and cached), table_to_img and the bot.button menu flow
+driven through a fake Telegram bot. Run from the repository root:
+
+    python3 -m benchmarks.run --depth 500 --latency 0.05 --iterations 50
+"""
+
+import argparse
+import logging
+import time
+import tracemalloc
+
+import config as config
+from benchmarks.fakebot import FakeBot, FakeContext, FakeUpdate
+from benchmarks.standin import Fixtures, StandIn
+
+MENU_FLOW = ['sell', 'all', 'eur', 'alloffers', 'text', 'query']
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, int(round(pct / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def count_rows(pages):
+    # every page repeats the header row
+    return sum(page.count('\n| ') - 1 for page in pages)
+
+
+def reset_caches():
+    from utils import cache, prices, results
+    cache.books.clear()
+    prices.snapshot = prices.PriceSnapshot(config.PRICE_REFRESH_INTERVAL)
+    results.sessions = results.ResultSessions(config.RESULT_SESSIONS, config.RESULT_SESSION_TTL)
+
+
+def measure(name, scenario, iterations, setup=None):
+    """Run scenario several times and return its latency, throughput and memory
+
+    Args:
+        name (string): label of the report line
+        scenario (callable): returns the number of rows it produced
+        iterations (int): timed runs
+        setup (callable): run before every iteration, outside the timing
+    """
+    latencies = []
+    rows = 0
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        rows += scenario()
+        latencies.append(time.perf_counter() - start)
+    # peak memory is measured on a separate run, tracemalloc slows down the code
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    scenario()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    total = sum(latencies)
+    return {'name': name, 'n': iterations,
+            'p50': percentile(latencies, 50) * 1000, 'p99': percentile(latencies, 99) * 1000,
+            'rows_s': rows / total if total else 0.0, 'peak_mb': peak / 2**20}
+
+
+def print_report(results):
+    print(f"{'scenario':28} {'n':>5} {'p50 ms':>9} {'p99 ms':>9} {'rows/s':>11} {'peak MB':>8}")
+    for r in results:
+        print(f"{r['name']:28} {r['n']:5d} {r['p50']:9.2f} {r['p99']:9.2f} "
+              f"{r['rows_s']:11.0f} {r['peak_mb']:8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--depth', type=int, default=200,
+                        help='synthetic offers per side and exchange, 0 for the samples')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every stand-in answer')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--fiat', default='eur')
+    parser.add_argument('--skip-bot', action='store_true',
+                        help='do not import bot.py (needs python-telegram-bot)')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    standin = StandIn(Fixtures(args.depth), args.latency, args.jitter, args.error_rate).start()
+    standin.configure(config)
+    # measure the bot, not the Telegram flood limits
+    config.SEND_GLOBAL_RATE = config.SEND_CHAT_RATE = None
+
+    from utils import utils
+
+    def query():
+        price, pages, missing = utils.print_orders(args.fiat, 'sell', 'alloffers', 'all')
+        return count_rows(pages)
+
+    results = [
+        measure('print_orders (cold)', query, args.iterations, setup=reset_caches),
+        measure('print_orders (cached)', query, args.iterations),
+    ]
+
+    price, pages, missing = utils.print_orders(args.fiat, 'sell', 'alloffers', 'all')
+    page = f"BTC price: {price} {args.fiat.upper()}\nBTC sell offers:\n" + pages[0]
+
+    def render():
+        utils.table_to_img(page)
+        return count_rows(pages[:1])
+
+    results.append(measure('table_to_img', render, args.iterations,
+                           setup=utils._render_png.cache_clear))
+    results.append(measure('table_to_img (cached)', render, args.iterations))
+
+    if not args.skip_bot:
+        import bot
+        from utils import delivery, workers
+        fake = FakeBot()
+
+        def menu_flow():
+            context = FakeContext(fake, {'lang': 'en'})
+            first = len(fake.sent)
+            for data in MENU_FLOW:
+                bot.button(FakeUpdate(fake, 1, data), context)
+            # the query itself runs in the query worker pool
+            workers.queries.join()
+            delivery.outbox.join()
+            texts = [kwargs.get('text') or '' for _, kind, _, kwargs in fake.sent[first:]
+                     if kind == 'message']
+            return sum(max(0, text.count('\n| ') - 1) for text in texts)
+
+        results.append(measure('bot.button flow (cold)', menu_flow, args.iterations,
+                               setup=reset_caches))
+        results.append(measure('bot.button flow (cached)', menu_flow, args.iterations))
+
+    print(f"depth={args.depth} latency={args.latency}s error_rate={args.error_rate} "
+          f"upstream requests={standin.requests}")
+    print_report(results)
+    standin.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+"""Local stand-in for the Bisq, Bisq price, Robosats and HodlHodl APIs
+
+Serves the sample documents in benchmarks/fixtures, or synthetic books of
+any depth, with injectable latency and errors. Point config.BISQ_URL,
+BISQ_PRICE_URL, ROBOSATS_URL and HODLHODL_URL to it and set
+config.TOR_PORT = None.
+
+    python3 -m benchmarks.standin --port 8700 --depth 500 --latency 0.2
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Enable logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+ROBOSATS_CURRENCIES = {"1": "USD", "2": "EUR", "3": "JPY", "4": "GBP", "7": "CHF", "8": "CNY"}
+METHODS = ["SEPA", "SEPA_INSTANT", "Revolut", "Bizum", "Strike", "MONERO", "Cash by mail",
+           "Any national bank", "Wise", "Amazon GiftCard"]
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name)) as f:
+        return json.load(f)
+
+
+class Fixtures:
+    """Documents served by the stand-in
+
+    Args:
+        depth (int): offers per side and exchange. 0 serves the EUR samples
+            in benchmarks/fixtures for every currency
+        seed (int): seed of the synthetic books
+    """
+
+    def __init__(self, depth=0, seed=1):
+        self.depth = depth
+        self.prices = load_fixture('bisq_price.json')
+        self.price_index = {item['currencyCode']: item['price'] for item in self.prices['data']}
+        self._rng = random.Random(seed)
+        self._books = {}
+        self._lock = threading.Lock()
+
+    def _price(self, fiat):
+        return self.price_index.get(fiat.upper(), 30000.0)
+
+    def _synthetic(self, fiat):
+        rng = self._rng
+        ref = self._price(fiat)
+        book = {'bisq': {'buys': [], 'sells': []}, 'robosats': [], 'hodlhodl': []}
+        for side in ['buy', 'sell']:
+            for i in range(self.depth):
+                # buyers bid under the market price, sellers ask over it
+                premium = rng.uniform(-12, 2) if side == 'buy' else rng.uniform(-2, 12)
+                price = ref * (1 + premium / 100)
+                btc = round(rng.uniform(0.001, 0.5), 8)
+                method = rng.choice(METHODS)
+                book['bisq'][side + 's'].append({
+                    "offer_id": f"syn-{fiat}-{side}-{i}", "offer_date": 1658820000000 + i,
+                    "direction": side.upper(), "min_amount": f"{btc / 4:.8f}", "amount": f"{btc:.8f}",
+                    "price": f"{price:.8f}", "volume": f"{btc * price:.8f}",
+                    "payment_method": method, "offer_fee_txid": "0"})
+                amount = int(btc * price)
+                ranged = rng.random() < 0.5
+                book['robosats'].append({
+                    "id": len(book['robosats']), "type": 0 if side == 'buy' else 1,
+                    "currency": 2, "amount": None if ranged else str(amount), "has_range": ranged,
+                    "min_amount": str(amount // 4) if ranged else None,
+                    "max_amount": str(amount) if ranged else None,
+                    "payment_method": method, "premium": f"{premium:.2f}", "price": int(price)})
+                payment = [{"id": str(i), "type": "Bank wire", "name": method}]
+                book['hodlhodl'].append({
+                    "id": f"syn-{i}", "side": side, "currency_code": fiat.upper(),
+                    "price": f"{price:.1f}", "min_amount": str(amount // 4), "max_amount": str(amount),
+                    "payment_method_instructions": [{"payment_method_name": method}],
+                    "payment_methods": payment,
+                    "trader": {"online_status": "online" if rng.random() < 0.8 else "offline"}})
+        return book
+
+    def book(self, fiat):
+        fiat = fiat.lower()
+        with self._lock:
+            if fiat not in self._books:
+                if self.depth:
+                    self._books[fiat] = self._synthetic(fiat)
+                else:
+                    self._books[fiat] = {
+                        'bisq': load_fixture('bisq_offers_eur.json')['btc_eur'],
+                        'robosats': load_fixture('robosats_book_eur.json'),
+                        'hodlhodl': load_fixture('hodlhodl_offers_eur.json')['offers']}
+            return self._books[fiat]
+
+    def route(self, path, query):
+        """Return the document for a request path, or None if it is unknown"""
+        if path == '/getAllMarketPrices':
+            return self.prices
+        elif path == '/api/offers':
+            fiat = query['market'][0].split('_')[1].lower()
+            market = self.book(fiat)['bisq']
+            if 'direction' in query:
+                side = query['direction'][0].lower() + 's'
+                market = {side: market[side]}
+            return {f"btc_{fiat}": market}
+        elif path == '/api/book/':
+            fiat = ROBOSATS_CURRENCIES[query['currency'][0]]
+            offers = self.book(fiat)['robosats']
+            if query['type'][0] != '2':
+                offers = [offer for offer in offers if offer['type'] == int(query['type'][0])]
+            return offers or {"not_found": "No orders found"}
+        elif path == '/api/v1/offers':
+            offers = self.book(query['filters[currency_code]'][0])['hodlhodl']
+            if 'filters[side]' in query:
+                offers = [offer for offer in offers if offer['side'] == query['filters[side]'][0]]
+            return {"status": "success", "offers": offers}
+        return None
+
+
+class StandIn:
+    """Threaded HTTP server answering like the exchanges
+
+    Args:
+        fixtures (Fixtures): documents to serve
+        latency (float): seconds added to every answer
+        jitter (float): random seconds added on top of latency
+        error_rate (float): share of requests answered with a 503 HTML page
+        port (int): 0 picks a free port
+    """
+
+    def __init__(self, fixtures, latency=0.0, jitter=0.0, error_rate=0.0, port=0):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                standin.requests += 1
+                time.sleep(standin.latency + random.uniform(0, standin.jitter))
+                url = urlparse(self.path)
+                if random.random() < standin.error_rate:
+                    return self._reply(503, b'<html>503 Service Unavailable</html>', 'text/html')
+                try:
+                    document = standin.fixtures.route(url.path, parse_qs(url.query))
+                except (KeyError, IndexError, ValueError):
+                    document = None
+                if document is None:
+                    return self._reply(404, b'{"detail": "not found"}', 'application/json')
+                self._reply(200, json.dumps(document).encode(), 'application/json')
+
+            def _reply(self, status, body, content_type):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logger.info("Exchange stand-in listening on " + self.url)
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def configure(self, config):
+        """Point the exchange adapters of the bot at this stand-in"""
+        config.TOR_PORT = None
+        config.BISQ_URL = self.url
+        config.BISQ_PRICE_URL = self.url
+        config.ROBOSATS_URL = self.url
+        config.HODLHODL_URL = self.url
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8700)
+    parser.add_argument('--depth', type=int, default=0,
+                        help='synthetic offers per side and exchange, 0 for the samples')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    standin = StandIn(Fixtures(args.depth), args.latency, args.jitter,
+                      args.error_rate, args.port)
+    logger.info("Exchange stand-in listening on " + standin.url)
+    standin.server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
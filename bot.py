@@ -4,7 +4,14 @@
 """This is a telegram bot to get offers from p2p exchanges like
     bisq, hodlhodl and robosats"""
 
+import atexit
 import logging
+import multiprocessing
+import queue
+import signal
+import sys
+import threading
+import time
 import i18n
 
 from telegram.ext.updater import Updater
@@ -13,11 +20,17 @@ from telegram.ext.callbackcontext import CallbackContext
 from telegram.ext.commandhandler import CommandHandler
 from telegram.ext.messagehandler import MessageHandler
 from telegram.ext.filters import Filters
-from telegram.ext import CallbackQueryHandler
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ParseMode
+from telegram.ext import CallbackQueryHandler, InlineQueryHandler
+from telegram.ext import Dispatcher, DispatcherHandlerStop, PicklePersistence, TypeHandler
+from telegram import Bot
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, ParseMode
+from telegram import InlineQueryResultArticle, InlineQueryResultCachedPhoto, InputTextMessageContent
+from telegram.error import BadRequest
 
 # Utils
-from utils.utils import print_orders, table_to_img
+from utils.utils import offers_table, query_offers, refresh_orders, table_to_img
+from utils import alerts, cache, delivery, depth, diff, history, inline, metrics, prices, resilience, results, shared, spread, workers
+from utils.table import TableBuilder
 
 import os
 
@@ -39,6 +52,9 @@ EMOJI_EN = '🇺🇸'
 EMOJI_ZH = '🇨🇳'
 EMOJI_IT = '🇮🇹'
 
+# Currencies offered in currency_url, kept warm in the order-book cache
+CURRENCIES = ['usd', 'eur', 'jpy', 'gbp', 'chf', 'cny']
+
 # read MODE env variable, fall back to 'polling' when undefined
 mode = os.environ.get("MODE", config.DEFAULT_CONNECTION)
 
@@ -52,8 +68,8 @@ logger = logging.getLogger(__name__)
 def start(update: Update, context: CallbackContext):
     if 'lang' not in context.user_data.keys():
         context.user_data["lang"] = 'en'
-    update.message.reply_text(
-        EMOJI_ROBOT + ' ' + i18n.t('menu.intro', locale=context.user_data["lang"]))
+    reply(update, context,
+          EMOJI_ROBOT + ' ' + i18n.t('menu.intro', locale=context.user_data["lang"]))
     action_url(update, context)
 
 
@@ -72,7 +88,7 @@ def language(update: Update, context: CallbackContext):
         ]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard_lang)
-    update.message.reply_text(i18n.t(
+    reply(update, context, i18n.t(
         'menu.language_select', locale=context.user_data["lang"]), reply_markup=reply_markup)
 
 
@@ -95,7 +111,21 @@ def help(update: Update, context: CallbackContext):
         i18n.t('menu.command_help', locale=context.user_data["lang"]) + '\n'
     text = text + '/lang - ' + \
         i18n.t('menu.command_lang', locale=context.user_data["lang"]) + '\n'
-    update.message.reply_text(text, reply_markup=reply_markup)
+    text = text + '/history - ' + \
+        i18n.t('menu.command_history', locale=context.user_data["lang"]) + '\n'
+    text = text + '/trend - ' + \
+        i18n.t('menu.command_trend', locale=context.user_data["lang"]) + '\n'
+    text = text + '/spread - ' + \
+        i18n.t('menu.command_spread', locale=context.user_data["lang"]) + '\n'
+    text = text + '/depth - ' + \
+        i18n.t('menu.command_depth', locale=context.user_data["lang"]) + '\n'
+    text = text + '/alert - ' + \
+        i18n.t('menu.command_alert', locale=context.user_data["lang"]) + '\n'
+    text = text + '/alerts - ' + \
+        i18n.t('menu.command_alerts', locale=context.user_data["lang"]) + '\n'
+    text = text + '/unalert - ' + \
+        i18n.t('menu.command_unalert', locale=context.user_data["lang"]) + '\n'
+    reply(update, context, text, reply_markup=reply_markup)
 
 
 def run_query(update: Update, context: CallbackContext):
@@ -124,25 +154,117 @@ def run_query(update: Update, context: CallbackContext):
     else:
         format = 'text'
 
-    price, result = print_orders(fiat, action, premium, exchange)
+    lang = context.user_data.get("lang", 'en')
+    status = workers.queries.submit(update.effective_user.id, lambda: answer_query(
+        update, context, fiat, action, premium, exchange, format))
+    if status == workers.DUPLICATE:
+        reply(update, context, i18n.t('menu.query_in_progress', locale=lang))
+    elif status == workers.BUSY:
+        reply(update, context, i18n.t('menu.busy', locale=lang))
+    elif update.message is not None:
+        # the query button already shows the searching message
+        reply(update, context, i18n.t('menu.searching', locale=lang))
+
+
+def answer_query(update: Update, context: CallbackContext, fiat, action, premium, exchange, format):
+    """Fetch the offers and send their first page. Runs in the query worker pool
+
+    The offers are kept in a result session of the chat, so its buttons page,
+    sort and filter them without fetching them again. A recent session of
+    the same market is reused when the query only changes the premium.
+    """
+    with metrics.registry.timer('handler_seconds', handler='answer_query'):
+        chat_id = update.effective_chat.id
+        session = results.sessions.find(chat_id, fiat, action, exchange,
+                                           config.CACHE_REFRESH_INTERVAL)
+        if session is None:
+            price, offers, missing = query_offers(fiat, action, exchange)
+            session = results.sessions.open(chat_id, results.ResultSession(
+                fiat, action, exchange, price, offers, missing))
+        msg, reply_markup = render_results(session, results.View(premium=premium),
+                                           context.user_data.get("lang", 'en'))
+        send_result(update, context, msg, format, reply_markup=reply_markup)
+
+
+def render_results(session, view, lang):
+    """Render a page of a result session
+
+    Returns:
+        tuple: (message, InlineKeyboardMarkup with the page, sort and filter buttons)
+    """
+    offers, page, pages = session.page(view, config.RESULT_PAGE_ROWS)
+    msg = f"BTC price: {session.price} {session.fiat.upper()}\n" + \
+        f"BTC {session.direction} offers ({page + 1}/{pages}):\n{offers_table(offers)[0]}"
+    if session.missing:
+        msg = msg + '\n' + i18n.t('menu.partial_results', exchanges=', '.join(session.missing),
+                                  locale=lang)
+    return msg, result_buttons(session, view.replace(page=page), pages)
+
+
+def result_buttons(session, view, pages):
+    """Buttons showing the other pages, sorts, methods and premiums of a view"""
+    def button(label, selected=False, **changes):
+        if selected:
+            label = f"· {label} ·"
+        return InlineKeyboardButton(label, callback_data=view.replace(**changes).encode(session.id))
+
+    keyboard = []
+    paging = []
+    if view.page > 0:
+        paging.append(button('«', page=view.page - 1))
+    if view.page < pages - 1:
+        paging.append(button('»', page=view.page + 1))
+    if paging:
+        keyboard.append(paging)
+    keyboard.append([button(label, view.sort == sort, sort=sort, page=0)
+                     for sort, label in [('price', 'Price'), ('amount', 'Amount'), ('method', 'Method')]])
+    methods = [button(method[:16], view.method == i, method=i, page=0)
+               for i, method in enumerate(session.methods[:config.RESULT_METHOD_BUTTONS])]
+    if len(session.methods) > 1:
+        keyboard.append(methods + [button('Any', view.method is None, method=None, page=0)])
+    sign = '>' if session.direction == 'buy' else '<'
+    keyboard.append([button(f"{sign}{premium}%", view.premium == premium, premium=premium, page=0)
+                     for premium in ['-3', '-1', '1', '3']] +
+                    [button('All', view.premium == 'alloffers', premium='alloffers', page=0)])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def browse_results(update: Update, context: CallbackContext):
+    """Show another page, sort or filter of a result message, from its session"""
+    query = update.callback_query
+    lang = context.user_data.get("lang", 'en')
+    decoded = results.View.decode(query.data)
+    session = None if decoded is None else results.sessions.get(update.effective_chat.id,
+                                                                 decoded[0])
+    if session is None:
+        query.answer(i18n.t('menu.results_expired', locale=lang), show_alert=True)
+        return
+    query.answer()
+    msg, reply_markup = render_results(session, decoded[1], lang)
+    try:
+        if query.message.photo:
+            query.edit_message_media(InputMediaPhoto(table_to_img(msg)), reply_markup=reply_markup)
+        else:
+            query.edit_message_text(f'```{msg}```', parse_mode=ParseMode.MARKDOWN_V2,
+                                    reply_markup=reply_markup)
+    except BadRequest as e:
+        # the button of the view already shown
+        if 'not modified' not in str(e):
+            raise
+
+
+def reply(update: Update, context: CallbackContext, text, priority=delivery.INTERACTIVE, **kwargs):
+    """Queue a message to the chat of update in the rate-limited outbox"""
+    delivery.outbox.send_message(context.bot, update.effective_chat.id, text,
+                                 priority=priority, **kwargs)
 
-    msg = f"BTC price: {price} {fiat.upper()}\nBTC {action} offers:\n" + \
-        f"{result}"
 
+def send_result(update: Update, context: CallbackContext, msg, format, **kwargs):
     if format == 'img':
-        img = table_to_img(msg)
-        if update.message is None:
-            context.bot.send_photo(
-                update.callback_query.from_user.id, photo=img)
-        else:
-            update.message.reply_photo(photo=img)
+        delivery.outbox.send_photo(context.bot, update.effective_chat.id,
+                                   photo=table_to_img(msg), **kwargs)
     else:
-        if update.message is None:
-            context.bot.send_message(update.callback_query.from_user.id,
-                                     text=f'```{msg}```', parse_mode=ParseMode.MARKDOWN_V2)
-        else:
-            update.message.reply_text(
-                text=f'```{msg}```', parse_mode=ParseMode.MARKDOWN_V2)
+        reply(update, context, f'```{msg}```', parse_mode=ParseMode.MARKDOWN_V2, **kwargs)
 
 
 def button(update: Update, context: CallbackContext):
@@ -166,7 +288,7 @@ def button(update: Update, context: CallbackContext):
         query.edit_message_text(i18n.t(
             'menu.exchange_reply', exchange=context.user_data["exchange"], locale=context.user_data["lang"]))
         currency_url(update, context)
-    elif query.data in ['usd', 'eur', 'jpy', 'gbp', 'chf', 'cny']:
+    elif query.data in CURRENCIES:
         context.user_data["currency"] = query.data
         query.answer()
         query.edit_message_text(i18n.t(
@@ -209,8 +331,8 @@ def exchange_url(update: Update, context: CallbackContext):
         ]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard_exchanges)
-    context.bot.send_message(chat_id=update.callback_query.from_user.id,
-                             text=i18n.t('menu.exchange_question', locale=context.user_data["lang"]), reply_markup=reply_markup)
+    reply(update, context,
+          i18n.t('menu.exchange_question', locale=context.user_data["lang"]), reply_markup=reply_markup)
 
 
 def currency_url(update: Update, context: CallbackContext):
@@ -227,8 +349,8 @@ def currency_url(update: Update, context: CallbackContext):
         ]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard_currencies)
-    context.bot.send_message(chat_id=update.callback_query.from_user.id,
-                             text=i18n.t('menu.currency_question', locale=context.user_data["lang"]), reply_markup=reply_markup)
+    reply(update, context,
+          i18n.t('menu.currency_question', locale=context.user_data["lang"]), reply_markup=reply_markup)
 
 
 def premium_url(update: Update, context: CallbackContext):
@@ -254,8 +376,8 @@ def premium_url(update: Update, context: CallbackContext):
         ]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard_premium)
-    context.bot.send_message(chat_id=update.callback_query.from_user.id,
-                             text=i18n.t('menu.premium_question', locale=context.user_data["lang"]), reply_markup=reply_markup)
+    reply(update, context,
+          i18n.t('menu.premium_question', locale=context.user_data["lang"]), reply_markup=reply_markup)
 
 
 def action_url(update: Update, context: CallbackContext):
@@ -268,8 +390,8 @@ def action_url(update: Update, context: CallbackContext):
         ]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard_actions)
-    update.message.reply_text(
-        i18n.t('menu.action_question', locale=context.user_data["lang"]), reply_markup=reply_markup)
+    reply(update, context,
+          i18n.t('menu.action_question', locale=context.user_data["lang"]), reply_markup=reply_markup)
 
 
 def format_url(update: Update, context: CallbackContext):
@@ -282,12 +404,8 @@ def format_url(update: Update, context: CallbackContext):
         ]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard_format)
-    if update.message is None:
-        context.bot.send_message(chat_id=update.callback_query.from_user.id,
-                                 text=i18n.t('menu.format_question', locale=context.user_data["lang"]), reply_markup=reply_markup)
-    else:
-        update.message.reply_text(text=i18n.t(
-            'menu.format_question', locale=context.user_data["lang"]), reply_markup=reply_markup)
+    reply(update, context,
+          i18n.t('menu.format_question', locale=context.user_data["lang"]), reply_markup=reply_markup)
 
 
 def query_url(update: Update, context: CallbackContext):
@@ -296,33 +414,381 @@ def query_url(update: Update, context: CallbackContext):
             'menu.start_search', locale=context.user_data["lang"]), callback_data='query')]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard_runquery)
-    if update.message is None:
-        context.bot.send_message(chat_id=update.callback_query.from_user.id,
-                                 text=i18n.t('menu.run_query', locale=context.user_data["lang"]), reply_markup=reply_markup)
-    else:
-        update.message.reply_text(text=i18n.t(
-            'menu.run_query', locale=context.user_data["lang"]), reply_markup=reply_markup)
+    reply(update, context,
+          i18n.t('menu.run_query', locale=context.user_data["lang"]), reply_markup=reply_markup)
+
+
+def describe_alert(sub):
+    method = f" ({sub.method.upper()})" if sub.method else ''
+    return f"#{sub.id}: {sub.direction} {sub.currency.upper()} {sub.premium}% {sub.exchange}{method}"
+
+
+def add_alert(update: Update, context: CallbackContext):
+    """Subscribe to the current query choices. Optional argument: payment method"""
+    lang = context.user_data.get("lang", 'en')
+    premium = context.user_data.get("premium", "alloffers")
+    if premium == "alloffers":
+        reply(update, context, i18n.t('menu.alert_needs_premium', locale=lang))
+        return
+    chat_id = update.effective_user.id
+    if len(alerts.index.list(chat_id)) >= config.MAX_ALERTS_PER_USER:
+        reply(update, context, i18n.t('menu.alert_limit', locale=lang))
+        return
+    sub = alerts.Subscription(chat_id, context.user_data.get("currency", "eur"),
+                              context.user_data.get("action", "buy"), int(premium),
+                              context.user_data.get("exchange", "all"),
+                              ' '.join(context.args) or None, lang)
+    alerts.index.add(sub)
+    reply(update, context, i18n.t('menu.alert_added', alert=describe_alert(sub), locale=lang))
+
+
+def list_alerts(update: Update, context: CallbackContext):
+    lang = context.user_data.get("lang", 'en')
+    subs = alerts.index.list(update.effective_user.id)
+    if not subs:
+        reply(update, context, i18n.t('menu.alert_list_empty', locale=lang))
+        return
+    reply(update, context, '\n'.join(describe_alert(sub) for sub in subs))
+
+
+def remove_alert(update: Update, context: CallbackContext):
+    """Remove the alert given as argument, or every alert of the user"""
+    lang = context.user_data.get("lang", 'en')
+    sub_id = None
+    if context.args and context.args[0].lstrip('#').isdigit():
+        sub_id = int(context.args[0].lstrip('#'))
+    removed = alerts.index.remove(update.effective_user.id, sub_id)
+    reply(update, context, i18n.t('menu.alert_removed', count=removed, locale=lang))
+
+
+def market_args(context: CallbackContext):
+    """Read '[currency] [buy|sell]' command arguments, defaulting to the user's choices
+
+    Returns:
+        tuple: (fiat, action, remaining arguments)
+    """
+    fiat = context.user_data.get("currency", "eur")
+    action = context.user_data.get("action", "buy")
+    rest = []
+    for arg in context.args or []:
+        if arg.lower() in CURRENCIES:
+            fiat = arg.lower()
+        elif arg.lower() in ['buy', 'sell']:
+            action = arg.lower()
+        else:
+            rest.append(arg)
+    return fiat, action, rest
+
+
+def format_dif(dif):
+    return '-' if dif is None else f"{dif:4.1f}%"
+
+
+def show_history(update: Update, context: CallbackContext):
+    """Last refreshes of a market: /history [currency] [buy|sell]"""
+    fiat, action, rest = market_args(context)
+    rows = history.store.history(fiat, action)
+    if not rows:
+        reply(update, context, i18n.t('menu.history_empty', locale=context.user_data.get("lang", 'en')))
+        return
+    table = TableBuilder(['Time (UTC)', 'Price', 'Best', 'Avg', 'Offers'], config.TABLE_PAGE_LENGTH)
+    for ts, price, offers, best, avg, volume in rows:
+        table.add_row([time.strftime('%m-%d %H:%M', time.gmtime(ts)), price or '-',
+                       format_dif(best), format_dif(avg), offers])
+    for page in table.pages():
+        send_result(update, context, f"BTC {action} offers {fiat.upper()}:\n{page}", 'text')
+
+
+def show_trend(update: Update, context: CallbackContext):
+    """Daily premium trend of a market: /trend [currency] [buy|sell] [days]"""
+    fiat, action, rest = market_args(context)
+    days = 7
+    if rest and rest[0].isdigit():
+        days = min(int(rest[0]), config.HISTORY_MAX_DAYS)
+    rows = history.store.trend(fiat, action, days)
+    if not rows:
+        reply(update, context, i18n.t('menu.history_empty', locale=context.user_data.get("lang", 'en')))
+        return
+    table = TableBuilder(['Day', 'Price', 'Best', 'Avg', 'Offers'], config.TABLE_PAGE_LENGTH)
+    for day, price, best, avg, offers in rows:
+        table.add_row([time.strftime('%Y-%m-%d', time.gmtime(day)),
+                       '-' if price is None else int(price), format_dif(best), format_dif(avg),
+                       f"{offers:.0f}"])
+    for page in table.pages():
+        send_result(update, context, f"BTC {action} offers {fiat.upper()}, {days}d:\n{page}", 'text')
+
+
+def format_range(low, high):
+    return '-' if low is None else f"{low}-{high}"
+
+
+def show_spread(update: Update, context: CallbackContext):
+    """Best sell against best buy offer of every exchange pair: /spread [currency]"""
+    fiat, action, rest = market_args(context)
+    spreads = spread.index.spreads(fiat)
+    if not spreads:
+        reply(update, context, i18n.t('menu.spread_empty', locale=context.user_data.get("lang", 'en')))
+        return
+    table = TableBuilder(['Buy at', 'Sell at', 'Ask', 'Bid', 'Gap', 'Amount'],
+                         config.TABLE_PAGE_LENGTH)
+    for row in spreads:
+        table.add_row([row.ask.exchange, row.bid.exchange, format_dif(row.ask.dif),
+                       format_dif(row.bid.dif), format_dif(row.gap),
+                       format_range(row.min_amount, row.max_amount)])
+    for page in table.pages():
+        send_result(update, context, f"BTC spread {fiat.upper()}:\n{page}", 'text')
+
+
+def show_depth(update: Update, context: CallbackContext):
+    """Offers and liquidity by distance to the market price: /depth [currency] [buy|sell]"""
+    fiat, action, rest = market_args(context)
+    bands = depth.index.get(fiat, action)
+    if not bands or not bands[-1].offers:
+        reply(update, context, i18n.t('menu.depth_empty', locale=context.user_data.get("lang", 'en')))
+        return
+    most = bands[-1].btc or 1
+    sign = '>=' if action == 'buy' else '<='
+    table = TableBuilder(['Premium', 'Offers', 'BTC', fiat.upper(), ''], config.TABLE_PAGE_LENGTH)
+    for band in bands:
+        limit = 'all' if band.limit is None else f"{sign}{-band.limit if action == 'buy' else band.limit}%"
+        table.add_row([limit, band.offers, f"{band.btc:.3f}", f"{band.amount:n}",
+                       ('#' * round(10 * band.btc / most)).ljust(10)])
+    for page in table.pages():
+        send_result(update, context, f"BTC {action} offers {fiat.upper()}, depth:\n{page}",
+                    context.user_data.get("format", 'text'))
+
+
+def format_seconds(seconds):
+    return '-' if seconds is None else f"{seconds:.2f}s"
+
+
+def format_ratio(ratio):
+    return '-' if ratio is None else f"{ratio:.0%}"
+
+
+def show_stats(update: Update, context: CallbackContext):
+    """Exchange latencies, errors, breakers and cache hit ratios. Only for config.ADMIN_IDS"""
+    if update.effective_user.id not in config.ADMIN_IDS:
+        return
+    registry = metrics.registry
+    errors = {}
+    for key, count in registry.counters('exchange_errors_total').items():
+        exchange = dict(key)['exchange']
+        errors[exchange] = errors.get(exchange, 0) + count
+    circuits = resilience.guard.states()
+    table = TableBuilder(['Exchange', 'Calls', 'p50', 'p99', 'Errors', 'Circuit'],
+                         config.TABLE_PAGE_LENGTH)
+    for key, histogram in sorted(registry.histograms('exchange_request_seconds').items()):
+        exchange = dict(key)['exchange']
+        table.add_row([exchange, histogram.count, format_seconds(histogram.quantile(0.5)),
+                       format_seconds(histogram.quantile(0.99)), errors.get(exchange, 0),
+                       circuits.get(exchange, '-')])
+    books = metrics.hit_ratio(registry.counters('cache_requests_total'))
+    images = metrics.hit_ratio(registry.collected('image_cache_requests_total') or {})
+    for page in table.pages():
+        send_result(update, context, page, 'text')
+    reply(update, context,
+          f"Cache hit ratio: books {format_ratio(books)}, images {format_ratio(images)}")
+
+
+def inline_query(update: Update, context: CallbackContext):
+    """Answer '@bot eur sell -3' from the pre-rendered results, never from the exchanges"""
+    query = update.inline_query
+    parsed = inline.parse_query(query.query, CURRENCIES)
+    answer = inline.results.answer(*parsed) if parsed else None
+    if answer is None:
+        query.answer([], cache_time=0, switch_pm_parameter='inline', switch_pm_text=i18n.t(
+            'menu.inline_no_results', locale=context.user_data.get("lang", 'en')))
+        return
+    results = [InlineQueryResultArticle(
+        id='text', title=answer.title, description=answer.description,
+        input_message_content=InputTextMessageContent(
+            f'```{answer.text}```', parse_mode=ParseMode.MARKDOWN_V2))]
+    if answer.photo_id:
+        results.append(InlineQueryResultCachedPhoto(
+            id='img', photo_file_id=answer.photo_id, title=answer.title,
+            description=answer.description))
+    query.answer(results, cache_time=config.CACHE_REFRESH_INTERVAL)
+
+
+def upload_inline_photos(bot, answers):
+    """Upload the tables of new inline answers to config.INLINE_PHOTO_CHAT to get their file_id
+
+    Uploads go through the outbox, after the alerts, and the file_id is
+    stored when Telegram accepted the photo.
+    """
+    for answer in inline.results.uploads(answers):
+        delivery.outbox.send_photo(
+            bot, config.INLINE_PHOTO_CHAT, table_to_img(answer.text), priority=delivery.BULK,
+            on_sent=lambda message, text=answer.text: inline.results.set_photo(
+                text, message.photo[-1].file_id),
+            disable_notification=True)
+
+
+def on_books(bot, books, diffs, upload=True):
+    """Renew the inline answers, spreads and depths, and send the alerts matched by refreshed books"""
+    inline.results.update(books)
+    spread.index.update(diffs)
+    depth.index.update(books)
+    for sub, offer in alerts.index.match_books(books):
+        delivery.outbox.send_message(bot, sub.chat_id, i18n.t(
+            'menu.alert_triggered', alert=describe_alert(sub), exchange=offer.exchange,
+            price=offer.price, currency=offer.currency, dif=f"{offer.dif:.1f}%",
+            min=offer.min_amount, max=offer.max_amount, method=offer.method, locale=sub.lang),
+            priority=delivery.BULK)
+    answers = inline.results.prerender(CURRENCIES)
+    if upload and config.INLINE_PHOTO_CHAT:
+        upload_inline_photos(bot, answers)
+
+
+def refresh_books(context: CallbackContext):
+    books, diffs = refresh_orders(CURRENCIES)
+    if config.HISTORY_DB:
+        history.store.record(books)
+    if shared.store is not None:
+        shared.store.publish(books, prices.snapshot.as_dict())
+    # the books of the last run were only good until now
+    cache.books.drop_stale()
+    on_books(context.bot, books, diffs)
+
+
+def user_persistence(path):
+    """Return the PicklePersistence keeping user_data in path, or None
+
+    user_data is only written to disk by flush_persistence, in one batch.
+    """
+    if not path:
+        return None
+    return PicklePersistence(path, store_chat_data=False, store_bot_data=False,
+                             store_callback_data=False, on_flush=True)
+
+
+def flush_persistence(context: CallbackContext):
+    context.dispatcher.persistence.flush()
 
 
 def unknown_text(update: Update, context: CallbackContext):
-    update.message.reply_text(
-        i18n.t('menu.not_recognized', message=update.message.text, locale=context.user_data["lang"]))
+    reply(update, context,
+          i18n.t('menu.not_recognized', message=update.message.text, locale=context.user_data["lang"]))
+
+
+def register_handlers(disp) -> None:
+    """Add every command, button and message handler of the bot to a Dispatcher"""
+    timed = metrics.registry.timed
+    disp.add_handler(CommandHandler('start', timed('start', start)))
+    disp.add_handler(CommandHandler('help', timed('help', help)))
+    disp.add_handler(CommandHandler('query', timed('query', run_query)))
+    disp.add_handler(CommandHandler('lang', timed('lang', language)))
+    disp.add_handler(CommandHandler('alert', timed('alert', add_alert)))
+    disp.add_handler(CommandHandler('alerts', timed('alerts', list_alerts)))
+    disp.add_handler(CommandHandler('unalert', timed('unalert', remove_alert)))
+    disp.add_handler(CommandHandler('history', timed('history', show_history)))
+    disp.add_handler(CommandHandler('trend', timed('trend', show_trend)))
+    disp.add_handler(CommandHandler('spread', timed('spread', show_spread)))
+    disp.add_handler(CommandHandler('depth', timed('depth', show_depth)))
+    disp.add_handler(CommandHandler('stats', show_stats))
+
+    disp.add_handler(CallbackQueryHandler(timed('results', browse_results), pattern='^res:'))
+    disp.add_handler(CallbackQueryHandler(timed('button', button)))
+    disp.add_handler(InlineQueryHandler(timed('inline', inline_query)))
+
+    # Filters out unknown messages.
+    disp.add_handler(MessageHandler(Filters.text, unknown_text))
+
+
+def forward_updates(queues):
+    """Return a handler passing every update to a worker process, sharded by user"""
+    def forward(update: Update, context: CallbackContext):
+        user = update.effective_user
+        shard = (user.id if user is not None else update.update_id) % len(queues)
+        queues[shard].put(update.to_dict())
+        raise DispatcherHandlerStop
+    return forward
+
+
+def run_worker(index, updates):
+    """Webhook worker process: handles the updates of its shard
+
+    Books and prices come from the store published by the refresher, so the
+    workers never query the exchanges themselves. New refreshes renew the
+    inline answers and trigger the alerts of the users of the shard.
+    """
+    bot = Bot(config.TOKEN)
+    cache.books = shared.SharedBookCache(shared.store, config.CACHE_TTL)
+    prices.snapshot = shared.SharedPrices(shared.store, config.PRICE_REFRESH_INTERVAL)
+    if config.SEND_GLOBAL_RATE:
+        # the flood limit is shared by every worker
+        delivery.outbox = delivery.Outbox(
+            config.SEND_WORKERS, config.SEND_GLOBAL_RATE / config.WEBHOOK_WORKERS,
+            config.SEND_CHAT_RATE, config.SEND_CHAT_BURST, config.SEND_RETRIES)
+    if config.METRICS_PORT:
+        metrics.registry.serve(config.METRICS_PORT + 1 + index)
+    # users always reach the same worker, which keeps their preferences
+    persistence = user_persistence(config.PERSISTENCE_FILE and f"{config.PERSISTENCE_FILE}.{index}")
+    disp = Dispatcher(bot, queue.Queue(), use_context=True, persistence=persistence)
+    register_handlers(disp)
+    if persistence is not None:
+        def flush():
+            disp.update_persistence()
+            persistence.flush()
+        atexit.register(flush)
+    # stopping the bot sends SIGTERM to the workers: exit through atexit,
+    # so the preferences changed since the last flush are written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    threading.Thread(target=disp.start, daemon=True, name='dispatcher').start()
+    logger.info("Webhook worker %d started" % index)
+    generation = None
+    flushed = time.monotonic()
+    while True:
+        try:
+            disp.update_queue.put(Update.de_json(updates.get(timeout=1), bot))
+        except queue.Empty:
+            pass
+        if persistence is not None and time.monotonic() - flushed > config.PERSISTENCE_INTERVAL:
+            persistence.flush()
+            flushed = time.monotonic()
+        snapshot = shared.store.load()
+        if snapshot.generation != generation:
+            generation = snapshot.generation
+            # books the refresher could not renew are as stale as in its cache
+            books = {key: book for key, (updated, book) in snapshot.books.items()
+                     if time.time() - updated <= config.CACHE_TTL}
+            # the file_ids of uploaded images are not shared between
+            # processes, so inline answers of the workers are text only
+            on_books(bot, books, diff.differ.update_books(books), upload=False)
 
 
 def main() -> None:
 
+    workers_mode = mode == 'webhook' and config.WEBHOOK_WORKERS
+    if workers_mode and shared.store is None:
+        # the workers read every book from the store
+        raise SystemExit("WEBHOOK_WORKERS needs SHARED_CACHE, set it in config.py")
+    # the webhook workers keep the preferences of their own users
+    persistence = None if workers_mode else user_persistence(config.PERSISTENCE_FILE)
     updater = Updater(config.TOKEN,
-                      use_context=True)
-    disp = updater.dispatcher
-    disp.add_handler(CommandHandler('start', start))
-    disp.add_handler(CommandHandler('help', help))
-    disp.add_handler(CommandHandler('query', run_query))
-    disp.add_handler(CommandHandler('lang', language))
+                      use_context=True, persistence=persistence)
+    if workers_mode:
+        # this process only refreshes the books and forwards the updates
+        spawn = multiprocessing.get_context('spawn')
+        queues = [spawn.Queue() for _ in range(config.WEBHOOK_WORKERS)]
+        for index, updates in enumerate(queues):
+            spawn.Process(target=run_worker, args=(index, updates), daemon=True,
+                          name=f'webhook-worker-{index}').start()
+        updater.dispatcher.add_handler(TypeHandler(Update, forward_updates(queues)))
+    else:
+        register_handlers(updater.dispatcher)
 
-    disp.add_handler(CallbackQueryHandler(button))
+    # Keep the order books warm so queries are answered from memory
+    if shared.store is not None:
+        shared.warm_start(shared.store, cache.books, prices.snapshot, config.WARM_START_MAX_AGE)
+    updater.job_queue.run_repeating(
+        refresh_books, interval=config.CACHE_REFRESH_INTERVAL, first=0)
+    if persistence is not None:
+        updater.job_queue.run_repeating(flush_persistence, interval=config.PERSISTENCE_INTERVAL)
 
-    # Filters out unknown messages.
-    disp.add_handler(MessageHandler(Filters.text, unknown_text))
+    if config.METRICS_PORT:
+        metrics.registry.serve(config.METRICS_PORT)
 
     if mode == 'webhook':
         PORT = os.environ.get("PORT", config.DEFAULT_CONNECTION)
@@ -331,7 +797,8 @@ def main() -> None:
                               webhook_url=config.APP_NAME + config.TOKEN)
     else:
         updater.start_polling()
-        updater.idle()
+    # flushes the persistence on SIGTERM
+    updater.idle()
 
 
 if __name__ == '__main__':
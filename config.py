@@ -1,11 +1,104 @@
 # -*- coding: utf-8 -*-
 # Your telegram bot token
 TOKEN = '<YOUR_TELEGRAM_BOT_TOKEN>'
-# Port where your Tor proxy is running
+# Port where your Tor proxy is running. None connects directly (e.g. to a local stand-in)
 TOR_PORT = '<YOUR_TOR_PROXY_PORT'
 # Payment methods to avoid. In lower case.
 avoid_methods = ["monero", "ripple", "litecoin"]
 DEFAULT_CONNECTION = 'polling'
 #In case you're using webhooks, please fill the following info:
 APP_NAME = 'https://<YOUR_WEBHOOK>'
-WEBHOOK_PORT = 8443 # YOUR WEBHOOK PORT
\ No newline at end of file
+WEBHOOK_PORT = 8443 # YOUR WEBHOOK PORT
+# Seconds to wait for the exchanges before answering with partial results
+EXCHANGE_DEADLINE = 20
+# Threads used to query the exchanges concurrently
+FETCH_WORKERS = 16
+# Seconds an order book is served from memory before querying the exchanges again
+CACHE_TTL = 120
+# Seconds between background refreshes of the order books
+CACHE_REFRESH_INTERVAL = 60
+# Idle Tor sessions kept per exchange, reusing their circuits and keep-alive connections
+TOR_POOL_SIZE = 4
+# Seconds and requests after which a pooled Tor session is recycled
+TOR_SESSION_MAX_AGE = 600
+TOR_SESSION_MAX_USES = 200
+# Tor circuit isolation: 'none', 'exchange' (one circuit per exchange) or 'session'
+TOR_ISOLATION = 'exchange'
+# Seconds between downloads of the Bisq market prices
+PRICE_REFRESH_INTERVAL = 60
+# Maximum characters of a table page. Telegram messages are limited to 4096
+TABLE_PAGE_LENGTH = 3800
+# Rendered images kept in memory
+IMAGE_CACHE_SIZE = 256
+# Exchange endpoints
+BISQ_URL = 'http://bisqmktse2cabavbr2xjq7xw3h6g5ottemo5rolfcwt6aly6tp5fdryd.onion'
+BISQ_PRICE_URL = 'http://wizpriceje6q5tdrxkyiazsgu7irquiqjy2dptezqhrtu7l2qelqktid.onion'
+ROBOSATS_URL = 'http://robosats6tkf3eva7x2voqso3a5wcorsnw34jveyxfqi2fu7oyheasid.onion'
+HODLHODL_URL = 'https://hodlhodl.com'
+# Threads answering queries, and queries accepted at once (running or waiting)
+QUERY_WORKERS = 8
+QUERY_QUEUE_SIZE = 64
+# Price alerts a user can keep at once
+MAX_ALERTS_PER_USER = 10
+# SQLite file storing a summary of every refreshed order book, for /history and /trend
+HISTORY_DB = 'history.sqlite3'
+# Refreshes waiting to be written before new ones are dropped
+HISTORY_QUEUE_SIZE = 100
+# Days of history kept, and the longest /trend
+HISTORY_MAX_DAYS = 90
+
+# Port of the Prometheus /metrics endpoint, None to disable it
+METRICS_PORT = 9100
+# Telegram user ids allowed to use /stats
+ADMIN_IDS = []
+# Seconds to connect and to wait for data in every exchange request
+REQUEST_TIMEOUT = (10, 15)
+# Extra attempts of a failed exchange call, after a jittered pause of up to
+# RETRY_BACKOFF * 2 ** attempt seconds
+EXCHANGE_RETRIES = 2
+RETRY_BACKOFF = 0.5
+# A duplicate request goes out over another circuit once an exchange is slower
+# than this percentile of its recent calls, None to disable hedging. Circuits
+# are only different with TOR_ISOLATION 'exchange' or 'session'
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_SAMPLES = 20
+# Failed calls in a row after which an exchange is skipped, and seconds before
+# it is tried again
+BREAKER_FAILURES = 5
+BREAKER_RESET = 60
+# Offers shown in an inline query answer (@bot eur sell -3)
+INLINE_TOP = 10
+# Chat the pre-rendered inline images are uploaded to, to get a file_id that
+# inline answers can reuse. None answers inline queries with text only. Only
+# the refresher uploads, so with WEBHOOK_WORKERS inline answers are text only
+INLINE_PHOTO_CHAT = None
+# Outgoing messages: threads calling Telegram, messages per second to all
+# chats and to one chat (None for no limit), messages a chat can get at once,
+# and attempts after network errors
+SEND_WORKERS = 4
+SEND_GLOBAL_RATE = 30
+SEND_CHAT_RATE = 1
+SEND_CHAT_BURST = 3
+SEND_RETRIES = 3
+# SQLite file the refresher publishes every refresh to, None to disable it
+SHARED_CACHE = 'books.sqlite3'
+# Webhook mode only: worker processes handling the updates, sharded by user.
+# They read the books from SHARED_CACHE and never query the exchanges. 0
+# handles the updates in the webhook process. Needs SHARED_CACHE
+WEBHOOK_WORKERS = 0
+# Books and prices of the last run younger than these seconds are served
+# from SHARED_CACHE after a restart, until the first refresh replaces them
+WARM_START_MAX_AGE = 3600
+# File keeping the preferences of the users (language, currency, format...)
+# across restarts, None to disable it, and seconds between writes
+PERSISTENCE_FILE = 'userdata.pickle'
+PERSISTENCE_INTERVAL = 60
+# Premium bands of /depth: liquidity within these % of the market price
+DEPTH_BANDS = [0, 1, 2, 3, 5, 10]
+# Query results kept per chat for the page, sort and filter buttons: chats
+# kept (the least recently used go first), seconds a result lives, offers per
+# page and payment methods offered as filters
+RESULT_SESSIONS = 1000
+RESULT_SESSION_TTL = 900
+RESULT_PAGE_ROWS = 20
+RESULT_METHOD_BUTTONS = 3
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
-import json
 import logging
-import requests
+from operator import attrgetter
+
+import config as config
+from exchanges.offer import Offer
 
 # Enable logging
 logging.basicConfig(
@@ -12,75 +14,63 @@ logger = logging.getLogger(__name__)
 
 class Bisq:
     
-    def getOffers(fiat, direction, refprice, session):
+    def getMarket(fiat, refprice, session):
+        """Get buy and sell offers of a market with a single request
+
+        Returns:
+            dict: 'buy' and 'sell' lists of offers
 
-        # fiat = eur, usd, 
-        # direction = buy or sell
-        # refprice = int
-        # tor = 1 or 0
+        Raises:
+            requests.exceptions.RequestException: the request failed
+            ValueError: the answer is not valid JSON
+        """
+        bisqBaseUrlTor = config.BISQ_URL
 
-        bisqBaseUrlTor = 'http://bisqmktse2cabavbr2xjq7xw3h6g5ottemo5rolfcwt6aly6tp5fdryd.onion'
+        bisqApi = f"{bisqBaseUrlTor}/api/offers?market=btc_{fiat.upper()}"
+        f = session.get(bisqApi, timeout=config.REQUEST_TIMEOUT)
+        f.raise_for_status()
+        values = f.json()
+        f.close()
+        market = values[f"btc_{fiat}"]
 
-        bisqApi = f"{bisqBaseUrlTor}/api/offers?market=btc_{fiat.upper()}&direction={direction.upper()}"
-        try:
-            f = session.get(bisqApi)
-        except requests.exceptions.Timeout as e:
-            # Maybe set up for a retry, or continue in a retry loop
-            logger.error("Error obtaining orders from Bisq (timeout): %s - %s" % (e.errno, e.strerror))
-            return []
-        except requests.exceptions.TooManyRedirects as e:
-            logger.error("Error obtaining orders from Bisq (too many redirects): %s - %s" % (e.errno, e.strerror))
-            return []
-        except requests.exceptions.RequestException as e:
-            logger.error("Error obtaining orders from Bisq: %s - %s" % (e.errno, e.strerror))
-            return []
-        try:
-            values = f.json()
-            f.close()
-        except json.decoder.JSONDecodeError as e:
-            logger.error("Error decoding orders from Bisq: %s - %s" % (e.errno, e.strerror))
-            return []
-        key = f"btc_{fiat}"
-        
+        return {'buy': Bisq.parseOffers(market.get('buys', []), fiat, refprice),
+                'sell': Bisq.parseOffers(market.get('sells', []), fiat, refprice)}
+
+    def parseOffers(lines, fiat, refprice):
         alloffers = []
 
-        for line in values[key][direction + 's' ]:
-            offer = {}
-            offer['exchange'] = 'Bisq'
-            offer['price'] = int(float(line['price']))
-            offer['dif'] = (offer['price']/refprice-1)*100
-            offer['min_btc'] = float(line['min_amount'])
-            offer['max_btc'] = float(line['amount'])
-            offer['min_amount'] = int(offer['min_btc'] * offer['price'])
-            offer['max_amount'] = int(float(line['volume']))
-            offer['method'] = line['payment_method']
-            alloffers.append(offer)
-        alloffers.sort(key=lambda item: item.get('price'))
+        for line in lines:
+            price = int(float(line['price']))
+            min_btc = float(line['min_amount'])
+            alloffers.append(Offer(
+                exchange='Bisq',
+                currency=fiat.upper(),
+                price=price,
+                dif=(price/refprice-1)*100 if refprice else float('nan'),
+                min_amount=int(min_btc * price),
+                max_amount=int(float(line['volume'])),
+                min_btc=min_btc,
+                max_btc=float(line['amount']),
+                method=line['payment_method'],
+                id=line.get('offer_id')))
+        alloffers.sort(key=attrgetter('price'))
         return alloffers
-    
-    def getFiatPrice(fiat, session):
-        bisqApi = 'http://wizpriceje6q5tdrxkyiazsgu7irquiqjy2dptezqhrtu7l2qelqktid.onion/getAllMarketPrices'
-        try:
-            f = session.get(bisqApi)
-        except requests.exceptions.Timeout as e:
-            # Maybe set up for a retry, or continue in a retry loop
-            logger.error("Error obtaining price from Bisq (timeout): %s - %s" % (e.errno, e.strerror))
-            return 1
-        except requests.exceptions.TooManyRedirects as e:
-            logger.error("Error obtaining price from Bisq (too many redirects): %s - %s" % (e.errno, e.strerror))
-            return 1
-        except requests.exceptions.RequestException as e:
-            logger.error("Error obtaining price from Bisq: %s - %s" % (e.errno, e.strerror))
-            return 1 
-            # * I return 1 instead of 0 to avoid errors raised dividing by the price    
-        
-        try:    
-            priceapi = f.json()
-            f.close()
-        except json.decoder.JSONDecodeError as e:
-            logger.error("Error decoding orders from Bisq: %s - %s" % (e.errno, e.strerror))
-            return 1
 
+    def getAllFiatPrices(session):
+        """Return a dict currency code (lower case) -> BTC price
+
+        Raises:
+            requests.exceptions.RequestException: the request failed
+            ValueError: the answer is not valid JSON
+        """
+        bisqApi = f"{config.BISQ_PRICE_URL}/getAllMarketPrices"
+        f = session.get(bisqApi, timeout=config.REQUEST_TIMEOUT)
+        f.raise_for_status()
+        priceapi = f.json()
+        f.close()
+
+        prices = {}
         for currency in priceapi['data']:
-            if (currency['currencyCode'].lower()==fiat):
-                return int(float(currency['price']))
+            prices[currency['currencyCode'].lower()] = int(float(currency['price']))
+        return prices
+
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
-import json
-import requests
 import logging
+from operator import attrgetter
+
+import config as config
+from exchanges.offer import Offer
 
 # Enable logging
 logging.basicConfig(
@@ -13,53 +15,55 @@ logger = logging.getLogger(__name__)
 
 class HodlHodl:
 
-    def getOffers(curr, direction, refprice, session):
+    def getMarket(curr, refprice, session):
+        """Get buy and sell offers of a market with a single request
+
+        Returns:
+            dict: 'buy' and 'sell' lists of offers
+
+        Raises:
+            requests.exceptions.RequestException: the request failed
+            ValueError: the answer is not valid JSON
+        """
         curr = curr.upper()
-        api = f"https://hodlhodl.com/api/v1/offers?filters[side]={direction}&filters[include_global]=true&filters[currency_code]={curr}&filters[only_working_now]=true&sort[by]=price"
-        try:
-            f = session.get(api)
-        except requests.exceptions.Timeout as e:
-        # Maybe set up for a retry, or continue in a retry loop
-            logger.error("Error obtaining orders from Robosats (timeout): %s - %s" % (e.errno, e.strerror))
-            return []
-        except requests.exceptions.TooManyRedirects as e:
-            logger.error("Error obtaining orders from Robosats (too many redirects): %s - %s" % (e.errno, e.strerror))
-            return []
-        except requests.exceptions.RequestException as e:
-            logger.error("Error obtaining orders from Robosats: %s - %s" % (e.errno, e.strerror))
-            return []
+        api = f"{config.HODLHODL_URL}/api/v1/offers?filters[include_global]=true&filters[currency_code]={curr}&filters[only_working_now]=true&sort[by]=price"
+        f = session.get(api, timeout=config.REQUEST_TIMEOUT)
+        f.raise_for_status()
+        jsonweb = f.json()
+        f.close()
+        alloffers = jsonweb['offers']
 
-        try:
-            jsonweb = f.json()
-            f.close()
-            alloffers = jsonweb['offers']
-        except json.decoder.JSONDecodeError as e:
-            logger.error("Error decoding orders from HodlHodl: %s - %s" % (e.errno, e.strerror))
-            return []
+        return {'buy': HodlHodl.parseOffers([offer for offer in alloffers if offer['side'] == 'buy'], 'buy', refprice),
+                'sell': HodlHodl.parseOffers([offer for offer in alloffers if offer['side'] == 'sell'], 'sell', refprice)}
 
+    def parseOffers(alloffers, direction, refprice):
         lista = []
 
         for offer in alloffers:
-            offers = {}
-            offers['exchange'] = "HodlHodl"
-            offers['price'] = int(float(offer['price']))
-            offers['dif'] = (offers['price']/refprice - 1)*100
-            offers['currency'] = offer['currency_code']
-            offers['min_amount'] = int(float(offer['min_amount']))
-            offers['max_amount'] = int(float(offer['max_amount']))
-            offers['min_btc'] = offers['min_amount']/offers['price']
-            offers['max_btc'] = offers['max_amount']/offers['price']
-            status = offer['trader']['online_status']
+            if (offer['trader']['online_status'] != 'online'):
+                continue
+            price = int(float(offer['price']))
+            min_amount = int(float(offer['min_amount']))
+            max_amount = int(float(offer['max_amount']))
             if (direction == "buy"):
-                offers['method'] = offer['payment_methods'][0]['name']
+                method = offer['payment_methods'][0]['name']
             else:
-                offers['method'] = offer['payment_method_instructions'][0]['payment_method_name']
-            if "SEPA" in offers['method']:
-                offers['method'] = "SEPA"
-            elif "Any national bank" in offers['method']:
-                offers['method'] = "NATIONAL_BANK"
-            if (status == 'online'):
-                lista.append(offers)
+                method = offer['payment_method_instructions'][0]['payment_method_name']
+            if "SEPA" in method:
+                method = "SEPA"
+            elif "Any national bank" in method:
+                method = "NATIONAL_BANK"
+            lista.append(Offer(
+                exchange="HodlHodl",
+                currency=offer['currency_code'],
+                price=price,
+                dif=(price/refprice - 1)*100 if refprice else float('nan'),
+                min_amount=min_amount,
+                max_amount=max_amount,
+                min_btc=min_amount/price,
+                max_btc=max_amount/price,
+                method=method,
+                id=offer.get('id')))
 
-        lista.sort(key=lambda item: item.get("price"))
+        lista.sort(key=attrgetter("price"))
         return lista
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+
+class Offer:
+    """An offer from any exchange
+
+    Attributes:
+        exchange (string): 'Bisq', 'Robosats' or 'HodlHodl'
+        currency (string): fiat currency code, e.g. 'EUR'
+        price (int): price of one BTC in fiat
+        dif (float): premium over the market price, in %
+        min_amount (int): minimum fiat amount
+        max_amount (int): maximum fiat amount
+        min_btc (float): minimum BTC amount
+        max_btc (float): maximum BTC amount
+        method (string): payment method
+        id (string): identifier of the offer in its exchange
+    """
+    __slots__ = ('exchange', 'currency', 'price', 'dif', 'min_amount', 'max_amount',
+                 'min_btc', 'max_btc', 'method', 'id')
+
+    def __init__(self, exchange, currency, price, dif, min_amount, max_amount,
+                 min_btc, max_btc, method, id=None):
+        self.exchange = exchange
+        self.currency = currency
+        self.price = price
+        self.dif = dif
+        self.min_amount = min_amount
+        self.max_amount = max_amount
+        self.min_btc = min_btc
+        self.max_btc = max_btc
+        self.method = method
+        self.id = id
+
+    def key(self):
+        """Stable identity of the offer across refreshes"""
+        if self.id is not None:
+            return (self.exchange, self.id)
+        return (self.exchange, self.price, self.min_amount, self.max_amount, self.method)
+
+    def __repr__(self):
+        return (f"Offer({self.exchange}, {self.price} {self.currency}, {self.dif:.1f}%, "
+                f"{self.min_amount}-{self.max_amount}, {self.method})")
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
-import json
-import requests
 import logging
+from operator import attrgetter
+
+import config as config
+from exchanges.offer import Offer
 
 # Enable logging
 logging.basicConfig(
@@ -17,60 +19,59 @@ currencies = {"1":"USD", "2":"EUR", "3":"JPY", "4":"GBP", "5":"AUD", "6":"CAD",
         "57":"THB", "58":"TTD", "59":"VND", "60":"XOF", "61":"TWD", "300":"XAU", "1000":"BTC"}
 
 class Robosats:
-    def getOffers(fiat, direction, session):
+    def getMarket(fiat, session):
+        """Get buy and sell offers of a market with a single request
+
+        Returns:
+            dict: 'buy' and 'sell' lists of offers
+
+        Raises:
+            requests.exceptions.RequestException: the request failed
+            ValueError: the answer is not valid JSON
+        """
+        robosatsTor = config.ROBOSATS_URL
 
-        robosatsTor = 'http://robosats6tkf3eva7x2voqso3a5wcorsnw34jveyxfqi2fu7oyheasid.onion'
- 
         key_list = list(currencies.keys())
         val_list = list(currencies.values())
         position = val_list.index(fiat.upper())
         currency = key_list[position]
 
-        if (direction=="sell"):
-            typeoffer = 1
-        else:
-            typeoffer = 0
+        # type 2 returns both buy (0) and sell (1) orders
+        command = f'/api/book/?currency={currency}&type=2'
+
+        f = session.get(robosatsTor + command, timeout=config.REQUEST_TIMEOUT)
+        f.raise_for_status()
+        values = f.json()
+        f.close()
+        if isinstance(values, dict):
+            # {"not_found": ...} when the book is empty
+            values = []
 
-        command = f'/api/book/?currency={currency}&type={typeoffer}'
+        return {'buy': Robosats.parseOffers([line for line in values if line['type'] == 0], fiat),
+                'sell': Robosats.parseOffers([line for line in values if line['type'] == 1], fiat)}
 
-        try:
-            f = session.get(robosatsTor + command)
-        except requests.exceptions.Timeout as e:
-            # Maybe set up for a retry, or continue in a retry loop
-            logger.error("Error obtaining orders from Robosats (timeout): %s - %s" % (e.errno, e.strerror))
-            return []
-        except requests.exceptions.TooManyRedirects as e:
-            logger.error("Error obtaining orders from Robosats (too many redirects): %s - %s" % (e.errno, e.strerror))
-            return []
-        except requests.exceptions.RequestException as e:
-            logger.error("Error obtaining orders from Robosats: %s - %s" % (e.errno, e.strerror))
-            return []
-        
-        try:
-            values = f.json()
-            f.close()
-        except json.decoder.JSONDecodeError as e:
-            logger.error("Error decoding orders from Robosats: %s - %s" % (e.errno, e.strerror))
-            return []
+    def parseOffers(values, fiat):
         alloffers = []
 
         for line in values:
-            if (line == "not_found"):
-                break
-            offer = {}
-            offer['exchange'] = 'Robosats'
-            offer['price'] = int(float(line['price']))
-            offer['dif'] = float(line['premium'])
+            price = int(float(line['price']))
             if (line['amount'] is not None):
-                offer['min_amount'] = int(float(line['amount']))
-                offer['max_amount'] = int(float(line['amount']))
+                min_amount = int(float(line['amount']))
+                max_amount = int(float(line['amount']))
             else:
-                offer['min_amount'] = int(float(line['min_amount']))
-                offer['max_amount'] = int(float(line['max_amount']))
-            offer['min_btc']=offer['min_amount']/offer['price']
-            offer['max_btc']=offer['max_amount']/offer['price']
-            offer['method']=line['payment_method']
-            alloffers.append(offer)
-        alloffers.sort(key=lambda item: item.get('price'))
+                min_amount = int(float(line['min_amount']))
+                max_amount = int(float(line['max_amount']))
+            alloffers.append(Offer(
+                exchange='Robosats',
+                currency=fiat.upper(),
+                price=price,
+                dif=float(line['premium']),
+                min_amount=min_amount,
+                max_amount=max_amount,
+                min_btc=min_amount/price,
+                max_btc=max_amount/price,
+                method=line['payment_method'],
+                id=line.get('id')))
+        alloffers.sort(key=attrgetter('price'))
 
         return alloffers
@@ -0,0 +1,174 @@
+import itertools
+import logging
+import math
+import threading
+from bisect import bisect_left, bisect_right
+
+import config as config
+
+# Enable logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """A price alert, built from the same choices as a query
+
+    Args:
+        chat_id (int): chat to notify
+        currency (string): usd, eur, ...
+        direction (string): 'buy' offers must be over the premium, 'sell'
+            offers under it, as in print_orders
+        premium (int): premium threshold, in %
+        exchange (string): 'all' or an exchange name
+        method (string): payment method, None for any
+        lang (string): language of the notifications
+    """
+    __slots__ = ('id', 'chat_id', 'currency', 'direction', 'premium', 'exchange',
+                 'method', 'lang', 'notified')
+
+    def __init__(self, chat_id, currency, direction, premium, exchange='all', method=None,
+                 lang='en'):
+        self.id = None
+        self.chat_id = chat_id
+        self.currency = currency
+        self.direction = direction
+        self.premium = premium
+        self.exchange = exchange.lower()
+        self.method = method.lower() if method else None
+        self.lang = lang
+        # last offer notified, so the same offer is not sent on every refresh
+        self.notified = None
+
+    def key(self):
+        return (self.currency, self.direction, self.exchange, self.method)
+
+
+def _better(direction, a, b):
+    # buy offers are better the higher the premium, sell offers the lower
+    return a > b if direction == 'buy' else a < b
+
+
+class AlertIndex:
+    """Subscriptions indexed by currency, direction, exchange, method and premium
+
+    Each refreshed book is scanned once to find the best offer of every
+    (exchange, method) group. Then, for every group that has subscriptions, a
+    binary search over the sorted thresholds returns the subscriptions the
+    best offer satisfies, so matching does not depend on how many alerts
+    exist that do not fire.
+    """
+
+    def __init__(self):
+        self._groups = {}
+        self._by_id = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def add(self, sub):
+        """Index a subscription and return its id"""
+        with self._lock:
+            sub.id = next(self._ids)
+            thresholds, subs = self._groups.setdefault(sub.key(), ([], []))
+            i = bisect_right(thresholds, sub.premium)
+            thresholds.insert(i, sub.premium)
+            subs.insert(i, sub)
+            self._by_id[sub.id] = sub
+        return sub.id
+
+    def remove(self, chat_id, sub_id=None):
+        """Remove one subscription of a chat, or all of them if sub_id is None
+
+        Returns:
+            int: number of subscriptions removed
+        """
+        with self._lock:
+            removed = [sub for sub in self._by_id.values() if sub.chat_id == chat_id
+                       and (sub_id is None or sub.id == sub_id)]
+            for sub in removed:
+                del self._by_id[sub.id]
+                thresholds, subs = self._groups[sub.key()]
+                i = subs.index(sub)
+                del thresholds[i]
+                del subs[i]
+                if not subs:
+                    del self._groups[sub.key()]
+        return len(removed)
+
+    def list(self, chat_id):
+        with self._lock:
+            return [sub for sub in self._by_id.values() if sub.chat_id == chat_id]
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def match(self, currency, direction, offers):
+        """Find the subscriptions satisfied by a book
+
+        Args:
+            currency (string): usd, eur, ...
+            direction (string): 'buy' or 'sell'
+            offers (list): offers of every exchange for currency and direction
+
+        Returns:
+            list: (subscription, offer) pairs with the best offer for each
+                subscription that was not notified before
+        """
+        # best offer of each (exchange, method) group, including 'all' and any method
+        best = {}
+        for offer in offers:
+            method = offer.method.lower()
+            if method in config.avoid_methods or math.isnan(offer.dif):
+                continue
+            exchange = offer.exchange.lower()
+            for key in ((exchange, method), (exchange, None), ('all', method), ('all', None)):
+                current = best.get(key)
+                if current is None or _better(direction, offer.dif, current.dif):
+                    best[key] = offer
+
+        matches = []
+        with self._lock:
+            for (exchange, method), offer in best.items():
+                group = self._groups.get((currency, direction, exchange, method))
+                if group is None:
+                    continue
+                thresholds, subs = group
+                if direction == 'buy':
+                    # dif > premium
+                    fired = subs[:bisect_left(thresholds, offer.dif)]
+                else:
+                    # dif < premium
+                    fired = subs[bisect_right(thresholds, offer.dif):]
+                for sub in fired:
+                    signature = (offer.exchange, offer.price, offer.method)
+                    if sub.notified != signature:
+                        sub.notified = signature
+                        matches.append((sub, offer))
+        return matches
+
+    def match_books(self, books):
+        """Match every book returned by fetch_orders
+
+        Every market is matched, changed or not: premiums follow the market
+        price, and new subscriptions must be checked against unchanged books.
+
+        Args:
+            books (dict): (exchange, fiat) -> {'buy': [...], 'sell': [...]}
+
+        Returns:
+            list: (subscription, offer) pairs
+        """
+        markets = {}
+        for (exchange, fiat), book in books.items():
+            for direction in ['buy', 'sell']:
+                markets.setdefault((fiat, direction), []).extend(book[direction])
+        matches = []
+        for (fiat, direction), offers in markets.items():
+            matches.extend(self.match(fiat, direction, offers))
+        return matches
+
+
+# Shared by the alert commands and the background refresher
+index = AlertIndex()
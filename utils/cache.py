@@ -0,0 +1,80 @@
+import logging
+import threading
+import time
+
+import config as config
+
+# Enable logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+class OrderBookCache:
+    """Thread safe cache of order books with a time to live
+
+    Keys are (exchange, fiat) tuples such as ('bisq', 'eur'), and values are
+    the whole book of that market: {'buy': [...], 'sell': [...]}. Market
+    prices are kept by prices.PriceSnapshot.
+    """
+    # misses are fetched from the exchanges by fetch_orders
+    fetch_misses = True
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._stale = {}
+        self._loader = None
+        self._lock = threading.Lock()
+
+    def preload(self, loader):
+        """Serve stale values until they are replaced or drop_stale() is called
+
+        Args:
+            loader (callable): returns a dict key -> value, e.g. the books of
+                the last run. It is only called on the first cache miss
+        """
+        with self._lock:
+            self._loader = loader
+
+    def drop_stale(self):
+        with self._lock:
+            self._loader = None
+            self._stale = {}
+
+    def _stale_value(self, key):
+        with self._lock:
+            if self._loader is not None:
+                loader, self._loader = self._loader, None
+                try:
+                    self._stale = loader()
+                except Exception as e:
+                    logger.error("Error loading stale entries: %r" % e)
+            return self._stale.get(key)
+
+    def get(self, key):
+        """Return the cached value, or None if it is missing or expired
+
+        Preloaded stale values are returned instead of None while they last.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            return self._stale_value(key)
+        return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._stale.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._stale = {}
+            self._loader = None
+
+
+# Shared by the handlers and the background refresher
+books = OrderBookCache(config.CACHE_TTL)
@@ -0,0 +1,305 @@
+import io
+import logging
+import threading
+import time
+from collections import deque
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError, Unauthorized
+
+import config as config
+from utils import metrics
+
+# Enable logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Priority lanes, lower goes first
+INTERACTIVE = 0
+BULK = 1
+
+# Telegram rejects longer texts
+MAX_MESSAGE_LENGTH = 4096
+
+
+class TokenBucket:
+    """rate tokens per second, up to burst of them saved. rate None is unlimited"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def wait(self, now):
+        """Seconds until a token is available, 0 if there is one now"""
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.rate is None:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.rate is not None:
+            self.tokens -= 1
+
+    def pause(self, now, seconds):
+        """No tokens for seconds, e.g. after a flood limit error"""
+        self.paused_until = now + seconds
+        self.tokens = 0
+        self.updated = self.paused_until
+
+    def full(self, now):
+        return self.wait(now) == 0 and (self.rate is None or self.tokens >= self.burst)
+
+
+class Outgoing:
+    __slots__ = ('bot', 'chat_id', 'method', 'kwargs', 'priority', 'attempts', 'on_sent')
+
+    def __init__(self, bot, chat_id, method, kwargs, priority, on_sent=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.method = method
+        self.kwargs = kwargs
+        self.priority = priority
+        self.attempts = 0
+        self.on_sent = on_sent
+
+    def merges_with(self, other):
+        """Whether other can be appended to this text message"""
+        return (self.method == other.method == 'send_message'
+                and self.bot is other.bot
+                and 'reply_markup' not in self.kwargs and 'reply_markup' not in other.kwargs
+                and self.kwargs.get('parse_mode') == other.kwargs.get('parse_mode')
+                and len(self.kwargs['text']) + 1 + len(other.kwargs['text'])
+                <= MAX_MESSAGE_LENGTH)
+
+
+class Outbox:
+    """Rate-limited delivery of every message the bot sends
+
+    Messages wait in one FIFO queue per chat, so pages arrive in order. Chats
+    are served round robin, interactive replies before bulk ones such as
+    alerts, as fast as a global token bucket and one bucket per chat allow.
+    Consecutive text messages to a chat are merged while they fit in one
+    Telegram message. A flood limit error (RetryAfter) pauses every chat for
+    the time Telegram asks, and the message is sent again afterwards.
+
+    Args:
+        workers (int): threads calling the Telegram API
+        global_rate (float): messages per second to all chats, None for no limit
+        chat_rate (float): messages per second to one chat, None for no limit
+        chat_burst (int): messages a chat can get at once after being idle
+        retries (int): attempts of a message after network errors
+    """
+
+    def __init__(self, workers, global_rate, chat_rate, chat_burst, retries):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retries = retries
+        self._global = TokenBucket(global_rate, global_rate or 1)
+        self._chats = {}
+        self._buckets = {}
+        self._lanes = {INTERACTIVE: deque(), BULK: deque()}
+        # chats in a lane, each chat is in at most one lane at a time
+        self._scheduled = set()
+        self._sending = set()
+        self._pending = 0
+        self._threads = []
+        self._cond = threading.Condition()
+
+    def send_message(self, bot, chat_id, text, priority=INTERACTIVE, **kwargs):
+        """Queue bot.send_message(chat_id, text=text, **kwargs)"""
+        kwargs['text'] = text
+        self._put(Outgoing(bot, chat_id, 'send_message', kwargs, priority))
+
+    def send_photo(self, bot, chat_id, photo, priority=INTERACTIVE, on_sent=None, **kwargs):
+        """Queue bot.send_photo(chat_id, photo=photo, **kwargs)
+
+        A file-like photo is read now: every attempt uploads it from a fresh
+        stream, since python-telegram-bot reads the stream to the end.
+
+        Args:
+            on_sent (callable): called with the sent Message, e.g. to keep
+                the file_id of the photo
+        """
+        if hasattr(photo, 'read'):
+            photo = photo.read()
+        kwargs['photo'] = photo
+        self._put(Outgoing(bot, chat_id, 'send_photo', kwargs, priority, on_sent))
+
+    def pending(self):
+        """Messages queued or being sent"""
+        with self._cond:
+            return self._pending
+
+    def join(self, timeout=None):
+        """Wait until every queued message was sent. Returns False on timeout"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._pending == 0, timeout)
+
+    def _start(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._send_loop, daemon=True,
+                                      name=f'outbox-{len(self._threads)}')
+            self._threads.append(thread)
+            thread.start()
+
+    def _put(self, message, first=False):
+        with self._cond:
+            self._start()
+            queue = self._chats.get(message.chat_id)
+            if queue is None:
+                queue = self._chats[message.chat_id] = deque()
+            if first:
+                queue.appendleft(message)
+            else:
+                queue.append(message)
+                self._pending += 1
+            self._schedule(message.chat_id, queue[0].priority)
+            self._cond.notify_all()
+
+    def _schedule(self, chat_id, priority):
+        """Put a chat in a lane unless it is already in one or being sent to
+
+        Must be called with the lock held.
+        """
+        if chat_id not in self._scheduled and chat_id not in self._sending:
+            self._scheduled.add(chat_id)
+            self._lanes[priority].append(chat_id)
+
+    def _next(self, now):
+        """Take the next message that may go out now, or return the seconds to wait
+
+        Must be called with the lock held.
+
+        Returns:
+            tuple: (message, number of queued messages merged in it), or
+                (None, seconds until a chat may get a message or None)
+        """
+        wait = None
+        for priority in (INTERACTIVE, BULK):
+            lane = self._lanes[priority]
+            for _ in range(len(lane)):
+                chat_id = lane.popleft()
+                queue = self._chats.get(chat_id)
+                if queue is None:
+                    self._scheduled.discard(chat_id)
+                    continue
+                bucket = self._buckets.get(chat_id)
+                if bucket is None:
+                    bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate,
+                                                                  self.chat_burst)
+                chat_wait = bucket.wait(now)
+                if chat_wait:
+                    lane.append(chat_id)
+                    wait = chat_wait if wait is None else min(wait, chat_wait)
+                    continue
+                bucket.take()
+                self._scheduled.discard(chat_id)
+                message = queue.popleft()
+                merged = 1
+                while queue and message.merges_with(queue[0]):
+                    message.kwargs['text'] += '\n' + queue.popleft().kwargs['text']
+                    merged += 1
+                if not queue:
+                    del self._chats[chat_id]
+                self._sending.add(chat_id)
+                return message, merged
+        return None, wait
+
+    def _done(self, chat_id, count):
+        with self._cond:
+            self._sending.discard(chat_id)
+            self._pending -= count
+            queue = self._chats.get(chat_id)
+            if queue:
+                self._schedule(chat_id, queue[0].priority)
+            elif len(self._buckets) > 2 * len(self._chats) + 1000:
+                # forget the buckets of idle chats, they would be full anyway
+                now = time.monotonic()
+                for idle in [idle for idle, bucket in self._buckets.items()
+                             if idle not in self._chats and idle not in self._sending
+                             and bucket.full(now)]:
+                    del self._buckets[idle]
+            self._cond.notify_all()
+
+    def _send_loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    global_wait = self._global.wait(now)
+                    if global_wait:
+                        self._cond.wait(global_wait)
+                        continue
+                    message, merged_or_wait = self._next(now)
+                    if message is not None:
+                        self._global.take()
+                        break
+                    self._cond.wait(merged_or_wait)
+            self._deliver(message, merged_or_wait)
+
+    def _deliver(self, message, merged):
+        message.attempts += 1
+        kwargs = message.kwargs
+        if isinstance(kwargs.get('photo'), bytes):
+            kwargs = dict(kwargs, photo=io.BytesIO(kwargs['photo']))
+        requeued = False
+        try:
+            sent = getattr(message.bot, message.method)(message.chat_id, **kwargs)
+            if message.on_sent is not None:
+                message.on_sent(sent)
+        except RetryAfter as e:
+            logger.warning("Flood limit reached, pausing for %ss" % e.retry_after)
+            metrics.registry.inc('outbox_retries_total', error='RetryAfter')
+            with self._cond:
+                self._global.pause(time.monotonic(), e.retry_after)
+            requeued = True
+        except (BadRequest, Unauthorized) as e:
+            # e.g. chat not found, bad markdown or the user blocked the bot:
+            # BadRequest is a NetworkError, but retrying does not help
+            logger.error("Error sending to %s: %r" % (message.chat_id, e))
+            metrics.registry.inc('outbox_dropped_total', error=type(e).__name__)
+        except NetworkError as e:
+            if message.attempts <= self.retries:
+                metrics.registry.inc('outbox_retries_total', error=type(e).__name__)
+                requeued = True
+            else:
+                logger.error("Error sending to %s: %r" % (message.chat_id, e))
+                metrics.registry.inc('outbox_dropped_total', error=type(e).__name__)
+        except TelegramError as e:
+            logger.error("Error sending to %s: %r" % (message.chat_id, e))
+            metrics.registry.inc('outbox_dropped_total', error=type(e).__name__)
+        except Exception as e:
+            logger.exception("Unexpected error sending to %s: %r" % (message.chat_id, e))
+            metrics.registry.inc('outbox_dropped_total', error=type(e).__name__)
+        else:
+            metrics.registry.inc('outbox_sent_total', priority=message.priority)
+        finally:
+            if requeued:
+                self._requeue(message, merged)
+            else:
+                self._done(message.chat_id, merged)
+
+    def _requeue(self, message, merged):
+        # the lock is reentrant and held throughout, so no message to the
+        # chat can be queued between the end of the attempt and the requeue
+        with self._cond:
+            self._sending.discard(message.chat_id)
+            # the merged text now counts as a single message
+            self._pending -= merged - 1
+            self._put(message, first=True)
+
+
+# Shared by every handler and job that sends messages
+outbox = Outbox(config.SEND_WORKERS, config.SEND_GLOBAL_RATE, config.SEND_CHAT_RATE,
+                config.SEND_CHAT_BURST, config.SEND_RETRIES)
+metrics.registry.collect('outbox_pending', outbox.pending)
@@ -0,0 +1,123 @@
+import logging
+import math
+import threading
+import time
+from bisect import bisect_left
+from itertools import accumulate
+
+import config as config
+
+# Enable logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+class Band:
+    """Liquidity of the offers within a distance of the market price
+
+    Attributes:
+        limit (float): distance to the market price in %, None for the band
+            holding every offer further than the last limit. Sell offers are
+            within it when dif <= limit, buy offers when dif >= -limit
+        offers (int): offers in this band and all the closer ones
+        btc (float): sum of their max_btc
+        amount (int): sum of their max_amount, in fiat
+    """
+    __slots__ = ('limit', 'offers', 'btc', 'amount')
+
+    def __init__(self, limit, offers, btc, amount):
+        self.limit = limit
+        self.offers = offers
+        self.btc = btc
+        self.amount = amount
+
+
+def depth(offers, direction, limits):
+    """Cumulative liquidity of a book by premium band
+
+    Every offer is placed in its band with one binary search and the bands
+    are summed in a single pass, then accumulated.
+
+    Args:
+        offers (iterable): offers of every exchange for one currency and direction
+        direction (string): 'buy' or 'sell'
+        limits (list): ascending distances to the market price, in %
+
+    Returns:
+        list: one Band per limit plus the band of the further offers
+    """
+    sign = -1 if direction == 'buy' else 1
+    count = [0] * (len(limits) + 1)
+    btc = [0.0] * (len(limits) + 1)
+    amount = [0] * (len(limits) + 1)
+    avoid = frozenset(method.lower() for method in config.avoid_methods)
+    for offer in offers:
+        if math.isnan(offer.dif) or offer.method.lower() in avoid:
+            continue
+        i = bisect_left(limits, sign * offer.dif)
+        count[i] += 1
+        btc[i] += offer.max_btc or 0.0
+        amount[i] += offer.max_amount or 0
+    return [Band(limit, *totals) for limit, *totals in
+            zip(list(limits) + [None], accumulate(count), accumulate(btc), accumulate(amount))]
+
+
+class DepthIndex:
+    """Depth of the combined book of every currency, computed once per refresh
+
+    Books not refreshed for max_age seconds, e.g. of an exchange that is
+    down, are left out, as the order-book cache does with its TTL.
+
+    Args:
+        limits (list): ascending distances to the market price, in %
+        max_age (float): seconds a book is used after its last refresh
+    """
+
+    def __init__(self, limits, max_age):
+        self.limits = sorted(limits)
+        self.max_age = max_age
+        # (exchange, fiat) -> (time of its last refresh, book)
+        self._books = {}
+        # fiat -> ({direction: bands}, time the oldest book used expires)
+        self._depths = {}
+        self._lock = threading.Lock()
+
+    def update(self, books):
+        """Store refreshed books and recompute the depth of their currencies
+
+        Args:
+            books (dict): (exchange, fiat) -> {'buy': [...], 'sell': [...]}
+        """
+        now = time.monotonic()
+        with self._lock:
+            for key, book in books.items():
+                self._books[key] = (now, book)
+            for fiat in {fiat for exchange, fiat in books}:
+                self._depths[fiat] = self._compute(fiat, now)
+
+    def _compute(self, fiat, now):
+        fresh = [(stored, book) for (exchange, book_fiat), (stored, book) in self._books.items()
+                 if book_fiat == fiat and now - stored <= self.max_age]
+        bands = {direction: depth([offer for stored, book in fresh for offer in book[direction]],
+                                  direction, self.limits)
+                 for direction in ['buy', 'sell']}
+        expires = min((stored + self.max_age for stored, book in fresh), default=math.inf)
+        return bands, expires
+
+    def get(self, fiat, direction):
+        """Return the Bands of a market, or None if it was never refreshed"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._depths.get(fiat)
+            if entry is None:
+                return None
+            if now > entry[1]:
+                # a book expired since the last refresh
+                entry = self._depths[fiat] = self._compute(fiat, now)
+            return entry[0][direction]
+
+
+# Updated by the background refresher, read by /depth
+index = DepthIndex(config.DEPTH_BANDS, config.CACHE_TTL)
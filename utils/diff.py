@@ -0,0 +1,97 @@
+import logging
+import threading
+
+# Enable logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Fields that make an offer with the same identity count as changed. dif
+# follows the market price, so fixed-price offers change when the market moves
+CHANGE_FIELDS = ('price', 'dif', 'min_amount', 'max_amount', 'method')
+
+
+class BookDiff:
+    """Offers added, removed and changed between two refreshes of a book
+
+    Attributes:
+        added (list): offers that were not in the previous book
+        removed (list): offers of the previous book that are gone
+        changed (list): (old, new) pairs of offers whose fields changed
+    """
+    __slots__ = ('added', 'removed', 'changed')
+
+    def __init__(self, added, removed, changed):
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def __repr__(self):
+        return (f"BookDiff(+{len(self.added)}, -{len(self.removed)}, "
+                f"~{len(self.changed)})")
+
+
+def _same(old, new):
+    # offers without a market price have a NaN dif, which is not equal to itself
+    return old == new or (old != old and new != new)
+
+
+def _changed(old, new):
+    return not all(_same(getattr(old, field), getattr(new, field)) for field in CHANGE_FIELDS)
+
+
+class BookDiffer:
+    """Keeps the last snapshot of every book and diffs new refreshes against it"""
+
+    def __init__(self):
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+    def update(self, key, offers):
+        """Store a refreshed book and return what changed since the last one
+
+        Args:
+            key (tuple): (exchange, fiat, direction)
+            offers (list): offers of the refreshed book
+
+        Returns:
+            BookDiff: the first snapshot of a book counts as all added
+        """
+        current = {offer.key(): offer for offer in offers}
+        with self._lock:
+            previous = self._snapshots.get(key, {})
+            self._snapshots[key] = current
+        added = []
+        changed = []
+        for identity, offer in current.items():
+            old = previous.get(identity)
+            if old is None:
+                added.append(offer)
+            elif _changed(old, offer):
+                changed.append((old, offer))
+        removed = [offer for identity, offer in previous.items() if identity not in current]
+        return BookDiff(added, removed, changed)
+
+    def update_books(self, books):
+        """Diff every book returned by fetch_orders
+
+        Args:
+            books (dict): (exchange, fiat) -> {'buy': [...], 'sell': [...]}
+
+        Returns:
+            dict: (exchange, fiat, direction) -> BookDiff
+        """
+        diffs = {}
+        for (exchange, fiat), book in books.items():
+            for direction in ['buy', 'sell']:
+                key = (exchange, fiat, direction)
+                diffs[key] = self.update(key, book[direction])
+        return diffs
+
+
+# Shared by the background refresher
+differ = BookDiffer()
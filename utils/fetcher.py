@@ -0,0 +1,63 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import config as config
+
+# Enable logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Shared pool: a hung exchange keeps one of its workers busy, never the caller
+_executor = ThreadPoolExecutor(max_workers=config.FETCH_WORKERS,
+                               thread_name_prefix='fetcher')
+
+
+def submit(job):
+    """Start an exchange call in the background
+
+    Jobs are started in submission order, so a job may block on the result
+    of a job submitted before it (e.g. offers waiting for the market price).
+
+    Args:
+        job (callable): function without arguments
+
+    Returns:
+        Future: future holding the result of the job
+    """
+    return _executor.submit(job)
+
+
+def gather(futures, deadline=None):
+    """Wait for several exchange calls, but no longer than the deadline
+
+    Args:
+        futures (dict): name -> Future, as returned by submit()
+        deadline (float): seconds to wait, config.EXCHANGE_DEADLINE by default
+
+    Returns:
+        tuple: (results, missing) where results maps the name of every finished
+            call to its value and missing lists the calls that failed or did
+            not answer in time
+    """
+    if deadline is None:
+        deadline = config.EXCHANGE_DEADLINE
+    start = time.monotonic()
+    wait(futures.values(), timeout=deadline)
+
+    results = {}
+    missing = []
+    for name, future in futures.items():
+        if not future.done():
+            logger.warning("%s did not answer in %.1f s" % (name, deadline))
+            missing.append(name)
+            continue
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            logger.error("Error obtaining data from %s: %r" % (name, e))
+            missing.append(name)
+    logger.info("Exchanges answered in %.2f s" % (time.monotonic() - start))
+    return results, missing
@@ -0,0 +1,176 @@
+import logging
+import math
+import queue
+import sqlite3
+import threading
+import time
+
+import config as config
+from utils import prices
+
+# Enable logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS snapshots (
+    ts INTEGER NOT NULL,
+    exchange TEXT NOT NULL,
+    currency TEXT NOT NULL,
+    direction TEXT NOT NULL,
+    market_price INTEGER,
+    offers INTEGER NOT NULL,
+    priced INTEGER NOT NULL,
+    best_dif REAL,
+    avg_dif REAL,
+    volume_btc REAL
+);
+CREATE INDEX IF NOT EXISTS snapshots_market ON snapshots (currency, direction, ts);
+'''
+
+
+def _summary(direction, offers):
+    """Return the number of offers with a premium, the best and the average premium
+
+    Offers of an exchange without a market price have no premium, averages
+    over several exchanges are weighted by the first value.
+    """
+    difs = [offer.dif for offer in offers if not math.isnan(offer.dif)]
+    if not difs:
+        return 0, None, None
+    # best for the user: highest premium for buy offers, lowest for sell offers
+    best = max(difs) if direction == 'buy' else min(difs)
+    return len(difs), best, sum(difs) / len(difs)
+
+
+class HistoryStore:
+    """SQLite store of the history of every refreshed order book
+
+    Every refresh adds one aggregate row per exchange and market to the
+    indexed 'snapshots' table, which history and trend queries read. Rows
+    older than config.HISTORY_MAX_DAYS are deleted.
+
+    Writes are queued and inserted in batches by a background thread, so
+    recording never waits for the disk.
+
+    Args:
+        path (string): SQLite database file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._queue = queue.Queue(maxsize=config.HISTORY_QUEUE_SIZE)
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def _start(self):
+        with self._lock:
+            if self._writer is None:
+                db = self._connect()
+                db.executescript(SCHEMA)
+                db.close()
+                self._writer = threading.Thread(target=self._write_loop, daemon=True,
+                                                name='history')
+                self._writer.start()
+
+    def record(self, books, ts=None):
+        """Queue refreshed books for storage. Never blocks
+
+        Args:
+            books (dict): (exchange, fiat) -> {'buy': [...], 'sell': [...]}
+            ts (int): unix time of the refresh, now by default
+        """
+        self._start()
+        refprices = {fiat: prices.snapshot.current(fiat) for exchange, fiat in books}
+        try:
+            self._queue.put_nowait((ts or int(time.time()), books, refprices))
+        except queue.Full:
+            logger.warning("History queue full, dropping a refresh")
+
+    def _write_loop(self):
+        db = self._connect()
+        pruned = 0
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            snapshot_rows = []
+            for ts, books, refprices in batch:
+                for (exchange, fiat), book in books.items():
+                    market_price = refprices[fiat]
+                    for direction in ['buy', 'sell']:
+                        offers = book[direction]
+                        priced, best, avg = _summary(direction, offers)
+                        snapshot_rows.append(
+                            (ts, exchange, fiat, direction, market_price, len(offers), priced,
+                             best, avg, sum(offer.max_btc for offer in offers)))
+            try:
+                with db:
+                    db.executemany('INSERT INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                   snapshot_rows)
+                    # hourly is enough, the retention is in days
+                    if time.time() - pruned > 3600:
+                        db.execute('DELETE FROM snapshots WHERE ts < ?',
+                                   (int(time.time()) - config.HISTORY_MAX_DAYS * 86400,))
+                        pruned = time.time()
+            except sqlite3.Error as e:
+                logger.error("Error storing history: %s" % e)
+
+    def history(self, currency, direction, limit=10):
+        """Last refreshes of a market, all exchanges combined
+
+        Returns:
+            list: (ts, market_price, offers, best_dif, avg_dif, volume_btc) rows,
+                newest first
+        """
+        self._start()
+        best = 'MAX' if direction == 'buy' else 'MIN'
+        db = self._connect()
+        try:
+            return db.execute(
+                f'SELECT ts, MAX(market_price), SUM(offers), {best}(best_dif), '
+                'SUM(avg_dif * priced) / SUM(priced), SUM(volume_btc) FROM snapshots '
+                'WHERE currency = ? AND direction = ? '
+                'GROUP BY ts ORDER BY ts DESC LIMIT ?',
+                (currency, direction, limit)).fetchall()
+        finally:
+            db.close()
+
+    def trend(self, currency, direction, days=7, bucket=86400):
+        """Premium trend of a market, aggregated in time buckets
+
+        Returns:
+            list: (bucket start, avg market_price, avg best_dif, avg avg_dif,
+                avg offers per refresh) rows, oldest first
+        """
+        self._start()
+        since = int(time.time()) - days * 86400
+        best = 'MAX' if direction == 'buy' else 'MIN'
+        db = self._connect()
+        try:
+            return db.execute(
+                'SELECT (ts / ?) * ?, AVG(market_price), AVG(best_dif), '
+                'SUM(dif_sum) / SUM(priced), AVG(offers) FROM ('
+                f'SELECT ts, MAX(market_price) AS market_price, {best}(best_dif) AS best_dif, '
+                'SUM(avg_dif * priced) AS dif_sum, SUM(priced) AS priced, SUM(offers) AS offers '
+                'FROM snapshots '
+                'WHERE currency = ? AND direction = ? AND ts >= ? GROUP BY ts) '
+                'GROUP BY ts / ? ORDER BY 1',
+                (bucket, bucket, currency, direction, since, bucket)).fetchall()
+        finally:
+            db.close()
+
+
+# Shared by the background refresher and the history commands
+store = HistoryStore(config.HISTORY_DB)
@@ -0,0 +1,175 @@
+import logging
+import re
+import threading
+import time
+
+import config as config
+from utils import pipeline, prices
+from utils.table import TableBuilder
+
+# Enable logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+EXCHANGE_NAMES = {'bisq': 'Bisq', 'robosats': 'Robosats', 'hodlhodl': 'HodlHodl'}
+
+PREMIUM = re.compile(r'[+-]?\d+')
+
+
+def parse_query(text, currencies):
+    """Read an inline query such as 'eur sell -3' or 'usd buy bisq'
+
+    Words can come in any order, and missing ones fall back to eur, sell,
+    every premium and every exchange.
+
+    Returns:
+        tuple: (fiat, direction, premium, exchange), or None if a word is not
+            understood
+    """
+    fiat, direction, premium, exchange = 'eur', 'sell', 'alloffers', 'all'
+    for word in text.lower().replace('%', ' ').split():
+        if word in currencies:
+            fiat = word
+        elif word in ['buy', 'sell']:
+            direction = word
+        elif word in EXCHANGE_NAMES or word == 'all':
+            exchange = word
+        elif PREMIUM.fullmatch(word):
+            premium = str(int(word))
+        else:
+            return None
+    return fiat, direction, premium, exchange
+
+
+class InlineAnswer:
+    """Pre-rendered answer to one inline query
+
+    Attributes:
+        title (string): first line of the result in the inline menu
+        description (string): best offer, shown under the title
+        text (string): table of the top offers
+        photo_id (string): file_id of the table uploaded as image, or None
+    """
+    __slots__ = ('title', 'description', 'text', 'photo_id')
+
+    def __init__(self, title, description, text):
+        self.title = title
+        self.description = description
+        self.text = text
+        self.photo_id = None
+
+
+class InlineResults:
+    """Top offers of every warm market, ready to answer inline queries
+
+    Inline queries must be answered within a few seconds, so they never reach
+    the exchanges: update() stores the books of each background refresh and
+    answers are rendered from memory, once per refresh.
+
+    Args:
+        top (int): offers shown in an answer
+        max_age (float): seconds a book is used after it was refreshed
+    """
+
+    def __init__(self, top, max_age):
+        self.top = top
+        self.max_age = max_age
+        self._books = {}
+        self._answers = {}
+        self._photos = {}
+        self._uploading = set()
+        self._lock = threading.Lock()
+
+    def update(self, books):
+        """Store refreshed books and drop the answers rendered from older ones
+
+        Args:
+            books (dict): (exchange, fiat) -> {'buy': [...], 'sell': [...]}
+        """
+        now = time.monotonic()
+        with self._lock:
+            for key, book in books.items():
+                self._books[key] = (now, book)
+            # an unchanged table keeps its uploaded image
+            self._photos = {answer.text: answer.photo_id for answer in self._answers.values()
+                            if answer.photo_id}
+            self._answers.clear()
+            # uploads that failed are tried again
+            self._uploading.clear()
+
+    def uploads(self, answers):
+        """Return the answers whose image must be uploaded, and mark them as uploading"""
+        with self._lock:
+            pending = [answer for answer in answers
+                       if answer.photo_id is None and answer.text not in self._uploading]
+            self._uploading.update(answer.text for answer in pending)
+        return pending
+
+    def set_photo(self, text, photo_id):
+        """Store the file_id of an uploaded table, for every answer showing it"""
+        with self._lock:
+            self._uploading.discard(text)
+            self._photos[text] = photo_id
+            for answer in self._answers.values():
+                if answer.text == text:
+                    answer.photo_id = photo_id
+
+    def prerender(self, currencies):
+        """Render the answers without filters, the most common inline queries
+
+        Returns:
+            list: the InlineAnswer of every warm market
+        """
+        answers = []
+        for fiat in currencies:
+            for direction in ['buy', 'sell']:
+                answer = self.answer(fiat, direction, 'alloffers', 'all')
+                if answer is not None:
+                    answers.append(answer)
+        return answers
+
+    def answer(self, fiat, direction, premium, exchange):
+        """Return the InlineAnswer of a query, or None if the market is not warm"""
+        key = (fiat, direction, premium, exchange)
+        with self._lock:
+            answer = self._answers.get(key)
+            if answer is not None:
+                return answer
+            now = time.monotonic()
+            streams = [book[direction] for (name, book_fiat), (stored, book) in self._books.items()
+                       if book_fiat == fiat and now - stored <= self.max_age
+                       and exchange in ('all', name)]
+        if not streams:
+            return None
+        answer = self._render(fiat, direction, premium, exchange,
+                              pipeline.select_offers(streams, direction, premium, self.top))
+        with self._lock:
+            answer.photo_id = self._photos.get(answer.text)
+            return self._answers.setdefault(key, answer)
+
+    def _render(self, fiat, direction, premium, exchange, offers):
+        price = prices.snapshot.current(fiat)
+        title = f"BTC {direction} offers {fiat.upper()}"
+        if premium != 'alloffers':
+            title += f" {'>' if direction == 'buy' else '<'} {premium}%"
+        if exchange != 'all':
+            title += f" ({EXCHANGE_NAMES[exchange]})"
+        if offers:
+            best = offers[0]
+            description = (f"{best.exchange}: {best.price:n} {fiat.upper()} ({best.dif:.1f}%), "
+                           f"{best.method}")
+        else:
+            description = '-'
+        table = TableBuilder(['Exchange', 'Price', 'Dif', 'Min', 'Max', 'Method'],
+                             config.TABLE_PAGE_LENGTH)
+        for offer in offers:
+            table.add_row([f"{offer.exchange:10}", f"{offer.price:8n}", f"{offer.dif:4.1f}%",
+                           f"{offer.min_amount:7n}", f"{offer.max_amount:7n}", f"{offer.method}"])
+        text = f"BTC price: {price} {fiat.upper()}\n{title}:\n{table.pages()[0]}"
+        return InlineAnswer(title, description, text)
+
+
+# Updated by the background refresher, read by the inline query handler
+results = InlineResults(config.INLINE_TOP, config.CACHE_TTL)
@@ -0,0 +1,191 @@
+import functools
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Enable logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Seconds. Onion services answer in anything from 100 ms to a minute
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+
+class Histogram:
+    """Cumulative latency histogram in the Prometheus style"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Estimate a quantile by interpolating inside its bucket"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Registry:
+    """Histograms, counters and collected series, each identified by name and labels"""
+
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._collected = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def collect(self, name, callback, kind='gauge'):
+        """Register a series read from callback at every scrape
+
+        Args:
+            name (string): metric name
+            callback (callable): returns a number, or a dict mapping sorted
+                (label, value) tuples to numbers
+            kind (string): 'gauge' or 'counter'
+        """
+        with self._lock:
+            self._collected[name] = (kind, callback)
+
+    def histograms(self, name):
+        with self._lock:
+            return dict(self._histograms.get(name, {}))
+
+    def counters(self, name):
+        with self._lock:
+            return dict(self._counters.get(name, {}))
+
+    def collected(self, name):
+        """Current value of a collected series, or None if it is not registered"""
+        with self._lock:
+            entry = self._collected.get(name)
+        return entry[1]() if entry else None
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the seconds spent in the with block, even if it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name, callback):
+        """Wrap a handler so its duration is observed as handler_seconds{handler=name}"""
+        @functools.wraps(callback)
+        def wrapper(*args, **kwargs):
+            with self.timer('handler_seconds', handler=name):
+                return callback(*args, **kwargs)
+        return wrapper
+
+    def render(self):
+        """Return every series in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            histograms = {name: dict(series) for name, series in self._histograms.items()}
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            collected = dict(self._collected)
+        for name, series in sorted(histograms.items()):
+            lines.append(f'# TYPE {name} histogram')
+            for key, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_labels(key + (("le", bound),))} {cumulative}')
+                lines.append(f'{name}_sum{_labels(key)} {histogram.sum}')
+                lines.append(f'{name}_count{_labels(key)} {histogram.count}')
+        for name, series in sorted(counters.items()):
+            lines.append(f'# TYPE {name} counter')
+            for key, value in series.items():
+                lines.append(f'{name}{_labels(key)} {value}')
+        for name, (kind, callback) in sorted(collected.items()):
+            try:
+                values = callback()
+            except Exception as e:
+                logger.error("Error collecting %s: %r" % (name, e))
+                continue
+            lines.append(f'# TYPE {name} {kind}')
+            if not isinstance(values, dict):
+                values = {(): values}
+            for key, value in values.items():
+                lines.append(f'{name}{_labels(key)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='0.0.0.0'):
+        """Expose render() on http://host:port/metrics from a daemon thread"""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True, name='metrics').start()
+        logger.info("Serving metrics on port %s" % port)
+        return server
+
+
+def hit_ratio(series):
+    """Fraction of hits in a {labels: count} series with a 'result' label, or None"""
+    hits = total = 0
+    for key, count in series.items():
+        total += count
+        if ('result', 'hit') in key:
+            hits += count
+    return hits / total if total else None
+
+
+def _labels(key):
+    if not key:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in key) + '}'
+
+
+# Shared by every instrumented component
+registry = Registry()
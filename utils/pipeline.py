@@ -0,0 +1,79 @@
+import heapq
+from itertools import islice
+from operator import attrgetter
+
+import config as config
+
+
+def method_filter(avoid=None):
+    """Return a predicate telling whether an offer's payment method is allowed
+
+    Lower-casing and the lookup in the avoided set are done once per distinct
+    method name, not once per offer.
+
+    Args:
+        avoid (list): methods to drop, config.avoid_methods by default
+    """
+    avoid = frozenset(method.lower() for method in (config.avoid_methods if avoid is None
+                                                    else avoid))
+    allowed = {}
+
+    def predicate(offer):
+        ok = allowed.get(offer.method)
+        if ok is None:
+            ok = allowed[offer.method] = offer.method.lower() not in avoid
+        return ok
+    return predicate
+
+
+def premium_filter(direction, limit):
+    """Return a predicate for the premium limit of a query, or None for 'alloffers'
+
+    Buy offers must be over the limit and sell offers under it.
+    """
+    if limit == "alloffers":
+        return None
+    limit = int(limit)
+    if direction == "buy":
+        return lambda offer: offer.dif > limit
+    return lambda offer: offer.dif < limit
+
+
+def merge_offers(streams, direction):
+    """Merge offer lists already sorted by ascending price into one stream
+
+    Buy offers come out from the highest price, sell offers from the lowest.
+    The merge is lazy, so taking the first N offers only touches N offers
+    and the heads of the streams.
+
+    Args:
+        streams (list): lists of offers, each sorted by ascending price
+        direction (string): 'buy' or 'sell'
+
+    Returns:
+        iterator: offers in display order
+    """
+    if direction == "buy":
+        return heapq.merge(*(reversed(stream) for stream in streams),
+                           key=attrgetter('price'), reverse=True)
+    return heapq.merge(*streams, key=attrgetter('price'))
+
+
+def select_offers(streams, direction, limit, top=None, avoid=None):
+    """Merge, filter and cut the offers of several exchanges
+
+    Args:
+        streams (list): lists of offers, each sorted by ascending price
+        direction (string): 'buy' or 'sell'
+        limit (string): premium limit, e.g. '-3', or 'alloffers'
+        top (int): stop after this many offers, None for all of them
+        avoid (list): methods to drop, config.avoid_methods by default
+
+    Returns:
+        list: selected offers in display order
+    """
+    offers = filter(method_filter(avoid), merge_offers(streams, direction))
+    premium = premium_filter(direction, limit)
+    if premium is not None:
+        offers = filter(premium, offers)
+    return list(islice(offers, top))
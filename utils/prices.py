@@ -0,0 +1,133 @@
+import logging
+import threading
+import time
+
+from exchanges.bisq import Bisq
+
+import config as config
+from utils import fetcher, metrics, resilience, sessions
+
+# Enable logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+def _download(circuit):
+    with sessions.pool.session(circuit) as session:
+        return Bisq.getAllFiatPrices(session)
+
+
+class PriceSnapshot:
+    """Market prices of every currency, downloaded once per refresh interval
+
+    Readers get the last good snapshot while a refresh is in flight. Only the
+    very first read blocks, because there is nothing to serve yet.
+    """
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self._prices = {}
+        self._updated = None
+        self._refreshing = False
+        self._loader = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def preload(self, loader):
+        """Serve prices saved by the last run until the first refresh
+
+        Args:
+            loader (callable): returns (age in seconds, {fiat: price}) or None.
+                It is only called on the first read
+        """
+        self._loader = loader
+
+    def _load(self):
+        with self._lock:
+            loader, self._loader = self._loader, None
+            if loader is None or self._updated is not None:
+                return
+            try:
+                saved = loader()
+            except Exception as e:
+                logger.error("Error loading saved prices: %r" % e)
+                return
+            if saved:
+                age, self._prices = saved
+                self._updated = time.monotonic() - age
+
+    def refresh(self, max_age=None):
+        """Download the market prices now. Keeps the old snapshot on errors
+
+        Args:
+            max_age (float): skip the download if another thread refreshed the
+                snapshot less than max_age seconds ago
+
+        Returns:
+            bool: True if the snapshot is up to date
+        """
+        with self._refresh_lock:
+            age = self.age()
+            if max_age is not None and age is not None and age < max_age:
+                return True
+            try:
+                prices = resilience.guard.timed_call("price", _download)
+            except Exception as e:
+                metrics.registry.inc('exchange_errors_total', exchange='price',
+                                     error=type(e).__name__)
+                logger.error("Error obtaining prices from Bisq: %r" % e)
+                return False
+            finally:
+                with self._lock:
+                    self._refreshing = False
+            if not prices:
+                return False
+            with self._lock:
+                self._prices = prices
+                self._updated = time.monotonic()
+        logger.info("Price snapshot updated (%d currencies)" % len(prices))
+        return True
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        fetcher.submit(self.refresh)
+
+    def age(self):
+        """Seconds since the last successful refresh, or None if there is none"""
+        if self._updated is None:
+            return None
+        return time.monotonic() - self._updated
+
+    def get(self, fiat):
+        """Return the price of fiat, or None if the currency is unknown
+
+        Args:
+            fiat (string): usd, eur, ...
+        """
+        if self._loader is not None:
+            self._load()
+        age = self.age()
+        if age is None:
+            self.refresh(self.max_age)
+        elif age > self.max_age:
+            self._refresh_in_background()
+        return self._prices.get(fiat)
+
+    def current(self, fiat):
+        """Return the last known price of fiat without triggering a refresh"""
+        if self._loader is not None:
+            self._load()
+        return self._prices.get(fiat)
+
+    def as_dict(self):
+        """Return every last known price, fiat -> price"""
+        return dict(self._prices)
+
+
+# Shared by every adapter and reference-price calculation
+snapshot = PriceSnapshot(config.PRICE_REFRESH_INTERVAL)
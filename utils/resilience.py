@@ -0,0 +1,242 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+
+import config as config
+from utils import metrics
+
+# Enable logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Errors worth another attempt: network failures, timeouts, error pages
+RETRYABLE = (requests.exceptions.RequestException, ValueError)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpen(Exception):
+    """The exchange failed too often recently and is not queried"""
+
+
+class DeadlineExceeded(Exception):
+    """No attempt answered before the deadline of the call"""
+
+
+class Endpoint:
+    """Recent latencies and circuit breaker of one exchange
+
+    The breaker opens after `failures` failed calls in a row. While open,
+    calls fail at once with CircuitOpen; after `reset` seconds a single trial
+    call is let through, and its outcome closes or reopens the breaker. Only
+    transport errors, retryable errors and missed deadlines count as failures.
+    """
+
+    def __init__(self, name, failures, reset, window=100):
+        self.name = name
+        self.failures = failures
+        self.reset = reset
+        self.state = CLOSED
+        self._failed = 0
+        self._opened = 0.0
+        self._trial = False
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call may go out now"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self._opened >= self.reset:
+                self.state = HALF_OPEN
+                self._trial = False
+            if self.state == HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def success(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+            self._failed = 0
+            if self.state != CLOSED:
+                logger.info("Circuit of %s closed" % self.name)
+            self.state = CLOSED
+
+    def failure(self):
+        with self._lock:
+            self._failed += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED
+                                           and self._failed >= self.failures):
+                if self.state == CLOSED:
+                    logger.warning("Circuit of %s opened after %d failures"
+                                   % (self.name, self._failed))
+                self.state = OPEN
+                self._opened = time.monotonic()
+
+    def release(self):
+        """End a call that neither succeeded nor failed, e.g. a parsing error"""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                # let another trial call through
+                self._trial = False
+
+    def hedge_delay(self, percentile, min_samples):
+        """Latency percentile of the recent successful calls, or None if too few"""
+        with self._lock:
+            if percentile is None or len(self._latencies) < min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[min(int(percentile * len(latencies)), len(latencies) - 1)]
+
+
+class Resilience:
+    """Retries, hedged requests and circuit breakers around exchange calls
+
+    A request is a callable taking a circuit name, the name of the pooled Tor
+    session it must use. Retries and hedges use other circuit names, so a
+    stalled onion circuit is not tried again.
+
+    Args:
+        retries (int): extra attempts after a retryable failure
+        backoff (float): base seconds of the jittered exponential backoff
+        hedge_percentile (float): latency percentile after which a duplicate
+            request is sent, None to disable hedging
+        hedge_min_samples (int): latencies needed before hedging starts
+        failures (int): failed calls in a row that open a breaker
+        reset (float): seconds before an open breaker lets a trial call through
+    """
+
+    def __init__(self, retries, backoff, hedge_percentile, hedge_min_samples, failures, reset):
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.failures = failures
+        self.reset = reset
+        self._endpoints = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2 * config.FETCH_WORKERS,
+                                            thread_name_prefix='attempt')
+
+    def endpoint(self, name):
+        with self._lock:
+            endpoint = self._endpoints.get(name)
+            if endpoint is None:
+                endpoint = self._endpoints[name] = Endpoint(name, self.failures, self.reset)
+            return endpoint
+
+    def states(self):
+        """Breaker state of every exchange called so far"""
+        with self._lock:
+            return {name: endpoint.state for name, endpoint in self._endpoints.items()}
+
+    def call(self, name, request, deadline=None):
+        """Run request for exchange name with retries, hedging and its breaker
+
+        Args:
+            name (string): exchange, also the circuit of the first attempt
+            request (callable): takes a circuit name and returns the result
+            deadline (float): seconds for the whole call, config.EXCHANGE_DEADLINE
+                by default
+
+        Returns:
+            the result of the first successful attempt
+
+        Raises:
+            CircuitOpen: the exchange is considered down
+            DeadlineExceeded: no attempt finished in time
+            Exception: the error of the last attempt
+        """
+        endpoint = self.endpoint(name)
+        if not endpoint.allow():
+            raise CircuitOpen(name)
+        end = time.monotonic() + (config.EXCHANGE_DEADLINE if deadline is None else deadline)
+        attempt = 0
+        while True:
+            circuit = name if attempt == 0 else f'{name}-retry{attempt}'
+            try:
+                result = self._hedged(endpoint, request, circuit, end)
+            except RETRYABLE as e:
+                pause = random.uniform(0, self.backoff * 2 ** attempt)
+                if attempt >= self.retries or time.monotonic() + pause >= end:
+                    endpoint.failure()
+                    raise
+                logger.info("Retrying %s in %.1fs after %r" % (name, pause, e))
+                metrics.registry.inc('exchange_retries_total', exchange=name)
+                time.sleep(pause)
+                attempt += 1
+            except DeadlineExceeded:
+                endpoint.failure()
+                raise
+            except Exception:
+                # the exchange answered, e.g. without the asked currency:
+                # one bad market must not open the breaker of every market
+                endpoint.release()
+                raise
+            else:
+                return result
+
+    def timed_call(self, name, request, deadline=None):
+        """call(), timed in exchange_request_seconds{exchange=name}
+
+        Calls refused by an open breaker are not timed, their instant
+        failures would skew the latency histogram.
+        """
+        start = time.perf_counter()
+        try:
+            return self.call(name, request, deadline)
+        except CircuitOpen:
+            start = None
+            raise
+        finally:
+            if start is not None:
+                metrics.registry.observe('exchange_request_seconds',
+                                         time.perf_counter() - start, exchange=name)
+
+    def _timed(self, endpoint, request, circuit):
+        start = time.monotonic()
+        result = request(circuit)
+        endpoint.success(time.monotonic() - start)
+        return result
+
+    def _hedged(self, endpoint, request, circuit, end):
+        """Run one attempt, racing a duplicate once it is slower than usual"""
+        pending = {self._executor.submit(self._timed, endpoint, request, circuit)}
+        delay = endpoint.hedge_delay(self.hedge_percentile, self.hedge_min_samples)
+        if delay is not None:
+            done, pending = wait(pending, timeout=min(delay, max(end - time.monotonic(), 0)))
+            if done:
+                return done.pop().result()
+            metrics.registry.inc('exchange_hedges_total', exchange=endpoint.name)
+            pending.add(self._executor.submit(self._timed, endpoint, request,
+                                              f'{circuit}-hedge'))
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(end - time.monotonic(), 0),
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                raise DeadlineExceeded(endpoint.name)
+            for future in done:
+                try:
+                    return future.result()
+                except Exception as e:
+                    error = e
+        raise error
+
+
+# Shared by every exchange call
+guard = Resilience(config.EXCHANGE_RETRIES, config.RETRY_BACKOFF, config.HEDGE_PERCENTILE,
+                   config.HEDGE_MIN_SAMPLES, config.BREAKER_FAILURES, config.BREAKER_RESET)
+metrics.registry.collect('exchange_circuit_open', lambda: {
+    (('exchange', name),): int(state != CLOSED) for name, state in guard.states().items()})
@@ -0,0 +1,213 @@
+import itertools
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import config as config
+from utils import metrics, pipeline
+
+# Enable logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+SORT_KEYS = {
+    # offers are merged in price order
+    'price': None,
+    'amount': lambda offer: -offer.max_amount,
+    'method': lambda offer: offer.method.lower(),
+}
+
+
+class View:
+    """What a result message shows: sort, filters and page
+
+    Views are written in full in the callback data of the buttons, so a
+    button always shows what it says, whatever the user clicked before.
+
+    Attributes:
+        sort (string): a SORT_KEYS key
+        method (int): index in ResultSession.methods of the only method
+            shown, None for every method
+        premium (string): premium limit, e.g. '-3', or 'alloffers'
+        page (int): page shown, from 0
+    """
+    __slots__ = ('sort', 'method', 'premium', 'page')
+
+    def __init__(self, sort='price', method=None, premium='alloffers', page=0):
+        self.sort = sort
+        self.method = method
+        self.premium = premium
+        self.page = page
+
+    def replace(self, **changes):
+        view = View(self.sort, self.method, self.premium, self.page)
+        for name, value in changes.items():
+            setattr(view, name, value)
+        return view
+
+    def encode(self, session_id):
+        """Return the callback data of a button showing this view"""
+        method = '-' if self.method is None else self.method
+        return f"res:{session_id}:{self.sort}:{method}:{self.premium}:{self.page}"
+
+    @staticmethod
+    def decode(data):
+        """Read callback data written by encode()
+
+        Returns:
+            tuple: (session id, View), or None if data is not valid
+        """
+        parts = data.split(':')
+        if len(parts) != 6 or parts[0] != 'res':
+            return None
+        prefix, session_id, sort, method, premium, page = parts
+        if (sort not in SORT_KEYS or not session_id.isdigit() or not page.isdigit()
+                or not (method == '-' or method.isdigit())
+                or not (premium == 'alloffers' or premium.lstrip('-').isdigit())):
+            return None
+        return int(session_id), View(sort, None if method == '-' else int(method), premium,
+                                     int(page))
+
+
+class ResultSession:
+    """Offers of one query, kept to show other pages, sorts and filters
+
+    Args:
+        fiat (string): usd, eur, ...
+        direction (string): 'buy' or 'sell'
+        exchange (string): exchange name, or 'all'
+        price (float): market price when the offers were fetched
+        offers (list): every offer of the query in price order, without
+            premium limit
+        missing (list): exchanges that did not answer
+    """
+
+    def __init__(self, fiat, direction, exchange, price, offers, missing):
+        self.id = None
+        self.fiat = fiat
+        self.direction = direction
+        self.exchange = exchange
+        self.price = price
+        self.offers = offers
+        self.missing = missing
+        self.created = time.monotonic()
+        # most common methods first, offered as filters
+        self.methods = [method for method, count in
+                        Counter(offer.method for offer in offers).most_common()]
+        self._views = {}
+        self._lock = threading.Lock()
+
+    def age(self):
+        return time.monotonic() - self.created
+
+    def select(self, view):
+        """Return the offers of a view, sorted and filtered, for every page
+
+        Results are memoized, so paging through a view only slices a list.
+        """
+        key = (view.sort, view.method, view.premium)
+        with self._lock:
+            offers = self._views.get(key)
+        if offers is not None:
+            return offers
+        offers = self.offers
+        if view.method is not None and view.method < len(self.methods):
+            method = self.methods[view.method]
+            offers = [offer for offer in offers if offer.method == method]
+        premium = pipeline.premium_filter(self.direction, view.premium)
+        if premium is not None:
+            offers = [offer for offer in offers if premium(offer)]
+        if SORT_KEYS[view.sort] is not None:
+            # sorted() is stable, so equal keys stay in price order
+            offers = sorted(offers, key=SORT_KEYS[view.sort])
+        with self._lock:
+            return self._views.setdefault(key, offers)
+
+    def page(self, view, rows):
+        """Return the offers on the page of a view and the number of pages
+
+        The page number is clamped to the pages of the view.
+        """
+        offers = self.select(view)
+        pages = max(1, -(-len(offers) // rows))
+        page = min(max(view.page, 0), pages - 1)
+        return offers[page * rows:(page + 1) * rows], page, pages
+
+
+class ResultSessions:
+    """Last ResultSession of every chat, with LRU and TTL eviction
+
+    Args:
+        max_sessions (int): sessions kept, the least recently used go first
+        ttl (float): seconds a session is kept after it was created
+    """
+
+    def __init__(self, max_sessions, ttl):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def open(self, chat_id, session):
+        """Store the session of a chat, replacing its previous one
+
+        Returns:
+            ResultSession: session, with its id set
+        """
+        session.id = next(self._ids)
+        with self._lock:
+            self._sessions[chat_id] = session
+            self._sessions.move_to_end(chat_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+            # the least recently used sessions are usually the expired ones
+            while self._sessions:
+                oldest = next(iter(self._sessions))
+                if self._sessions[oldest].age() <= self.ttl:
+                    break
+                del self._sessions[oldest]
+        return session
+
+    def get(self, chat_id, session_id=None):
+        """Return the live session of a chat, or None
+
+        Args:
+            session_id (int): only return the session if it has this id,
+                buttons of replaced sessions get None
+        """
+        with self._lock:
+            session = self._sessions.get(chat_id)
+            if session is None:
+                return None
+            if session.age() > self.ttl:
+                del self._sessions[chat_id]
+                return None
+            if session_id is not None and session.id != session_id:
+                return None
+            self._sessions.move_to_end(chat_id)
+            return session
+
+    def find(self, chat_id, fiat, direction, exchange, max_age):
+        """Return the session of a chat if it holds the offers of a query
+
+        Args:
+            max_age (float): only sessions younger than this are returned
+        """
+        session = self.get(chat_id)
+        if (session is None or session.age() > max_age or session.missing
+                or (session.fiat, session.direction, session.exchange) != (fiat, direction, exchange)):
+            return None
+        return session
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+# Last query results of every chat, read by the result buttons
+sessions = ResultSessions(config.RESULT_SESSIONS, config.RESULT_SESSION_TTL)
+
+metrics.registry.collect('result_sessions', lambda: len(sessions))
@@ -0,0 +1,205 @@
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+
+import config as config
+
+# Enable logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS books (
+    exchange TEXT NOT NULL,
+    fiat TEXT NOT NULL,
+    updated REAL NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (exchange, fiat)
+);
+CREATE TABLE IF NOT EXISTS prices (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    updated REAL NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    generation INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta VALUES (0, 0);
+'''
+
+
+class Snapshot:
+    """Books and prices of one published refresh
+
+    Attributes:
+        generation (int): number of refreshes published so far
+        books (dict): (exchange, fiat) -> (unix time of the refresh, book)
+        prices_updated (float): unix time of the prices, None if there are none
+        prices (dict): fiat -> price
+    """
+    __slots__ = ('generation', 'books', 'prices_updated', 'prices')
+
+    def __init__(self, generation, books, prices_updated, prices):
+        self.generation = generation
+        self.books = books
+        self.prices_updated = prices_updated
+        self.prices = prices
+
+
+class SharedStore:
+    """Order books and prices kept in a SQLite file shared by several processes
+
+    A single refresher publishes every refresh in one transaction. Readers
+    load the whole store in one read transaction, so they always see the
+    books and prices of the same refresh, and only read it again when the
+    generation counter moved.
+
+    Args:
+        path (string): SQLite database file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._snapshot = Snapshot(None, {}, None, {})
+        self._lock = threading.Lock()
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.executescript(SCHEMA)
+            self._local.db = db
+        return db
+
+    def publish(self, books, prices):
+        """Store the books and prices of a refresh. Older books of other markets stay
+
+        Args:
+            books (dict): (exchange, fiat) -> {'buy': [...], 'sell': [...]}
+            prices (dict): fiat -> price, nothing is stored if it is empty
+        """
+        now = time.time()
+        db = self._db()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            db.executemany('INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?)',
+                           [(exchange, fiat, now, pickle.dumps(book, pickle.HIGHEST_PROTOCOL))
+                            for (exchange, fiat), book in books.items()])
+            if prices:
+                db.execute('INSERT OR REPLACE INTO prices VALUES (0, ?, ?)',
+                           (now, pickle.dumps(prices, pickle.HIGHEST_PROTOCOL)))
+            db.execute('UPDATE meta SET generation = generation + 1')
+            db.execute('COMMIT')
+        except sqlite3.Error as e:
+            db.execute('ROLLBACK')
+            logger.error("Error publishing books: %r" % e)
+
+    def generation(self):
+        return self._db().execute('SELECT generation FROM meta').fetchone()[0]
+
+    def load(self):
+        """Return the Snapshot of the last published refresh"""
+        if self.generation() == self._snapshot.generation:
+            return self._snapshot
+        with self._lock:
+            db = self._db()
+            db.execute('BEGIN')
+            try:
+                generation = db.execute('SELECT generation FROM meta').fetchone()[0]
+                if generation == self._snapshot.generation:
+                    return self._snapshot
+                books = {(exchange, fiat): (updated, pickle.loads(data)) for exchange, fiat, updated, data
+                         in db.execute('SELECT exchange, fiat, updated, data FROM books')}
+                row = db.execute('SELECT updated, data FROM prices').fetchone()
+            finally:
+                db.execute('COMMIT')
+            prices = (row[0], pickle.loads(row[1])) if row else (None, {})
+            self._snapshot = Snapshot(generation, books, *prices)
+            return self._snapshot
+
+
+class SharedBookCache:
+    """Read-only OrderBookCache over a SharedStore, used by the worker processes
+
+    Misses are not fetched from the exchanges: only the refresher does that.
+    """
+    fetch_misses = False
+
+    def __init__(self, store, ttl):
+        self.store = store
+        self.ttl = ttl
+
+    def get(self, key):
+        entry = self.store.load().books.get(key)
+        if entry is None or time.time() - entry[0] > self.ttl:
+            return None
+        return entry[1]
+
+    def put(self, key, value):
+        pass
+
+    def clear(self):
+        pass
+
+
+class SharedPrices:
+    """Read-only PriceSnapshot over a SharedStore, used by the worker processes"""
+
+    def __init__(self, store, max_age):
+        self.store = store
+        self.max_age = max_age
+
+    def refresh(self, max_age=None):
+        # the refresher process downloads the prices
+        return self.age() is not None
+
+    def age(self):
+        updated = self.store.load().prices_updated
+        return None if updated is None else time.time() - updated
+
+    def get(self, fiat):
+        return self.store.load().prices.get(fiat)
+
+    def current(self, fiat):
+        return self.store.load().prices.get(fiat)
+
+
+def warm_start(store, books_cache, price_snapshot, max_age):
+    """Serve the books and prices of the last run until the first refresh
+
+    Nothing is read now: the store is loaded on the first query, and every
+    book or price is replaced as soon as a refresh brings a new one.
+
+    Args:
+        store (SharedStore): store the last run published to
+        books_cache (OrderBookCache): cache to preload
+        price_snapshot (PriceSnapshot): prices to preload
+        max_age (float): books and prices older than this are not used
+    """
+    def books():
+        now = time.time()
+        snapshot = store.load()
+        logger.info("Serving %d books of the last run" % len(snapshot.books))
+        return {key: book for key, (updated, book) in snapshot.books.items()
+                if now - updated <= max_age}
+
+    def saved_prices():
+        snapshot = store.load()
+        if snapshot.prices_updated is None or time.time() - snapshot.prices_updated > max_age:
+            return None
+        return time.time() - snapshot.prices_updated, snapshot.prices
+
+    books_cache.preload(books)
+    price_snapshot.preload(saved_prices)
+
+
+# Written by the refresher, read by the webhook workers
+store = SharedStore(config.SHARED_CACHE) if config.SHARED_CACHE else None
@@ -0,0 +1,53 @@
+import logging
+import threading
+
+from utils import metrics
+
+# Enable logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """Coalesces identical concurrent calls into a single one
+
+    While a call for a key is in flight, later calls for the same key get the
+    same Future instead of starting a new request. Every caller keeps its own
+    deadline when waiting on the Future, and an exception raised by the call
+    reaches every caller. Joined calls are counted as coalesced_calls_total.
+
+    Args:
+        submit (callable): starts a job and returns its Future, e.g. fetcher.submit
+    """
+
+    def __init__(self, submit):
+        self._submit = submit
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, job):
+        """Start job for key, or join the call already in flight
+
+        Args:
+            key: identifies identical calls, e.g. ('bisq', 'eur')
+            job (callable): function without arguments
+
+        Returns:
+            Future: result of the shared call
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                metrics.registry.inc('coalesced_calls_total')
+                return future
+            future = self._submit(job)
+            self._calls[key] = future
+        future.add_done_callback(lambda done: self._forget(key, done))
+        return future
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
@@ -0,0 +1,169 @@
+import heapq
+import itertools
+import logging
+import math
+import threading
+import time
+
+import config as config
+
+# Enable logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+class OfferHeap:
+    """Heap of the offers of one book, best first, updated offer by offer
+
+    Removed and changed offers are not searched in the heap: their entries
+    are skipped when they reach the top, and the heap is rebuilt once stale
+    entries outnumber the live ones.
+
+    Args:
+        direction (string): 'buy' offers are best at the highest price,
+            'sell' offers at the lowest
+    """
+
+    def __init__(self, direction):
+        self.sign = -1 if direction == 'buy' else 1
+        self._heap = []
+        self._live = {}
+        self._seq = itertools.count()
+
+    def add(self, offer):
+        seq = next(self._seq)
+        self._live[offer.key()] = (seq, offer)
+        heapq.heappush(self._heap, (self.sign * offer.price, seq, offer.key()))
+
+    def remove(self, offer):
+        self._live.pop(offer.key(), None)
+        if len(self._heap) > 2 * len(self._live) + 16:
+            self._heap = [(self.sign * live.price, seq, key)
+                          for key, (seq, live) in self._live.items()]
+            heapq.heapify(self._heap)
+
+    def top(self):
+        """Return the best live offer, or None if the book is empty"""
+        while self._heap:
+            price, seq, key = self._heap[0]
+            entry = self._live.get(key)
+            if entry is not None and entry[0] == seq:
+                return entry[1]
+            heapq.heappop(self._heap)
+        return None
+
+    def __len__(self):
+        return len(self._live)
+
+
+class Spread:
+    """Best sell offer of one exchange against the best buy offer of another
+
+    Attributes:
+        ask (Offer): cheapest sell offer, where BTC is bought
+        bid (Offer): highest buy offer, where BTC is sold
+        gap (float): premium of the bid minus premium of the ask, in %.
+            Positive gaps can be arbitraged
+        min_amount (int): lowest fiat amount both offers accept, or None if
+            their amount ranges do not overlap
+        max_amount (int): highest fiat amount both offers accept, or None
+    """
+    __slots__ = ('ask', 'bid', 'gap', 'min_amount', 'max_amount')
+
+    def __init__(self, ask, bid):
+        self.ask = ask
+        self.bid = bid
+        self.gap = bid.dif - ask.dif
+        low = max(ask.min_amount, bid.min_amount)
+        high = min(ask.max_amount, bid.max_amount)
+        self.min_amount, self.max_amount = (low, high) if low <= high else (None, None)
+
+
+class SpreadIndex:
+    """Best buy and sell offer of every exchange and currency, and their spreads
+
+    update() applies the BookDiffs of a refresh to one OfferHeap per book and
+    recomputes the spreads of the refreshed currencies, so spreads() is a
+    lookup. Offers whose premium moved with the market price come as changed
+    offers and replace their heap entry. Books not refreshed for max_age seconds, e.g. of an exchange that
+    is down, are left out, as the order-book cache does with its TTL.
+
+    Args:
+        max_age (float): seconds a book is used after its last refresh
+    """
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self._heaps = {}
+        # (exchange, fiat) -> time of its last refresh
+        self._updated = {}
+        # fiat -> (spreads, time the oldest book used expires)
+        self._spreads = {}
+        self._lock = threading.Lock()
+
+    def update(self, diffs):
+        """Apply the diffs of a refresh
+
+        Args:
+            diffs (dict): (exchange, fiat, direction) -> BookDiff of every
+                refreshed book, including unchanged ones
+        """
+        now = time.monotonic()
+        with self._lock:
+            refreshed = set()
+            for (exchange, fiat, direction), delta in diffs.items():
+                self._updated[(exchange, fiat)] = now
+                refreshed.add(fiat)
+                if not delta:
+                    continue
+                heap = self._heaps.get((exchange, fiat, direction))
+                if heap is None:
+                    heap = self._heaps[(exchange, fiat, direction)] = OfferHeap(direction)
+                for offer in delta.removed:
+                    heap.remove(offer)
+                for old, new in delta.changed:
+                    heap.remove(old)
+                    if _usable(new):
+                        heap.add(new)
+                for offer in delta.added:
+                    if _usable(offer):
+                        heap.add(offer)
+            for fiat in refreshed:
+                self._spreads[fiat] = self._compute(fiat, now)
+
+    def _fresh(self, exchange, fiat, now):
+        updated = self._updated.get((exchange, fiat))
+        return updated is not None and now - updated <= self.max_age
+
+    def _compute(self, fiat, now):
+        fresh = [(exchange, direction, heap) for (exchange, book_fiat, direction), heap
+                 in self._heaps.items() if book_fiat == fiat and self._fresh(exchange, fiat, now)]
+        asks = [heap.top() for exchange, direction, heap in fresh if direction == 'sell']
+        bids = [heap.top() for exchange, direction, heap in fresh if direction == 'buy']
+        spreads = [Spread(ask, bid) for ask in asks if ask is not None
+                   for bid in bids if bid is not None]
+        expires = min((self._updated[(exchange, fiat)] + self.max_age
+                       for exchange, direction, heap in fresh), default=math.inf)
+        return sorted(spreads, key=lambda spread: spread.gap, reverse=True), expires
+
+    def spreads(self, fiat):
+        """Return the Spreads of every exchange pair of a currency, widest gap first"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._spreads.get(fiat)
+            if entry is None:
+                return []
+            if now > entry[1]:
+                # a book expired since the last refresh
+                entry = self._spreads[fiat] = self._compute(fiat, now)
+            return entry[0]
+
+
+def _usable(offer):
+    return offer.method.lower() not in config.avoid_methods and not math.isnan(offer.dif)
+
+
+# Updated by the background refresher, read by /spread
+index = SpreadIndex(config.CACHE_TTL)
@@ -0,0 +1,59 @@
+class TableBuilder:
+    """Render rows as text tables, split in pages of bounded length
+
+    The output looks like a PrettyTable with centered columns, but the cost is
+    linear in the number of rows: column widths are tracked while rows are
+    added and every row is rendered exactly once.
+
+    Args:
+        header (list): column names
+        max_length (int): maximum number of characters of a page
+    """
+
+    def __init__(self, header, max_length):
+        self.header = [str(cell) for cell in header]
+        self.max_length = max_length
+        self.widths = [len(cell) for cell in self.header]
+        self.rows = []
+
+    def add_row(self, row):
+        row = [str(cell) for cell in row]
+        for i, cell in enumerate(row):
+            if len(cell) > self.widths[i]:
+                self.widths[i] = len(cell)
+        self.rows.append(row)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _line(self, row):
+        cells = [cell.center(width) for cell, width in zip(row, self.widths)]
+        return '| ' + ' | '.join(cells) + ' |'
+
+    def pages(self):
+        """Return the table split in pages, each one with its own header
+
+        Returns:
+            list: strings of at most max_length characters (unless a single
+                row is longer than that). There is always at least one page.
+        """
+        border = '+' + '+'.join('-' * (width + 2) for width in self.widths) + '+'
+        head = border + '\n' + self._line(self.header) + '\n' + border + '\n'
+        # every page ends with the border
+        budget = self.max_length - len(head) - len(border)
+        pages = []
+        lines = []
+        length = 0
+        for row in self.rows:
+            line = self._line(row) + '\n'
+            if lines and length + len(line) > budget:
+                pages.append(head + ''.join(lines) + border)
+                lines = []
+                length = 0
+            lines.append(line)
+            length += len(line)
+        if lines:
+            pages.append(head + ''.join(lines) + border)
+        elif not pages:
+            pages.append(head.rstrip('\n'))
+        return pages
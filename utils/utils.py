@@ -1,6 +1,7 @@
 import logging
-import requests
 import io
+import os
+from functools import lru_cache
 
 # Exchange APIs
 from exchanges.bisq import Bisq
@@ -8,8 +9,10 @@ from exchanges.robosats import Robosats
 from exchanges.hodlhodl import HodlHodl
 
 import config as config
+from utils import cache, diff, fetcher, metrics, pipeline, prices, resilience, sessions
+from utils.singleflight import SingleFlight
+from utils.table import TableBuilder
 
-import prettytable as pt
 from PIL import Image, ImageDraw, ImageFont
 
 # Enable logging
@@ -18,13 +21,162 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+EXCHANGES = ["bisq", "robosats", "hodlhodl"]
 
-def get_tor_session():
-    logging.info("starting tor session")
-    session = requests.session()
-    session.proxies = {'http':  'socks5h://127.0.0.1:' + config.TOR_PORT,
-                       'https': 'socks5h://127.0.0.1:' + config.TOR_PORT}
-    return session
+# Market downloads in flight, shared by identical concurrent queries
+flights = SingleFlight(fetcher.submit)
+
+FONT_PATH = os.path.join(os.path.dirname(__file__), '..', 'fonts', 'FreeMono.ttf')
+FONT_SIZE = 15
+IMAGE_MARGIN = 10
+IMAGE_LINE_SPACING = 4
+
+
+def _get_market(exchange, fiat, refprice):
+    """Query both sides of one market. refprice is a callable returning the market price
+
+    Returns None when the exchange fails. Failed requests are retried and slow
+    ones hedged by resilience.guard, which also skips exchanges known to be
+    down. The time spent in the exchange call and the type of every error are
+    recorded in the metrics registry.
+    """
+    logging.info("Obtaining orders from %s..." % exchange)
+    price = None if exchange == "robosats" else refprice()
+
+    def request(circuit):
+        with sessions.pool.session(circuit) as session:
+            if exchange == "robosats":
+                return Robosats.getMarket(fiat, session)
+            elif exchange == "bisq":
+                return Bisq.getMarket(fiat, price, session)
+            elif exchange == "hodlhodl":
+                return HodlHodl.getMarket(fiat, price, session)
+    try:
+        return resilience.guard.timed_call(exchange, request)
+    except Exception as e:
+        metrics.registry.inc('exchange_errors_total', exchange=exchange,
+                             error=type(e).__name__)
+        logger.error("Error obtaining orders from %s: %r" % (exchange, e))
+        return None
+
+
+def fetch_orders(fiats, exchanges, use_cache=True):
+    """Get the market price and the order books of several markets at once
+
+    Each market is downloaded once for both directions. Books come from the
+    order-book cache when they are fresh enough, the rest are fetched
+    concurrently and stored in the cache. Concurrent callers asking for the
+    same market share a single request. A cache that does not fetch misses,
+    like the shared cache of the webhook workers, reports them as missing.
+
+    Args:
+        fiats (list): currencies, e.g. ['usd', 'eur']
+        exchanges (list): exchange names
+        use_cache (bool): False to always query the exchanges
+
+    Returns:
+        tuple: (prices, books, missing) where prices maps each fiat to its
+            price, books maps (exchange, fiat) to a dict with the 'buy' and
+            'sell' offers and missing lists the keys that did not answer
+    """
+    books = {}
+    futures = {}
+    missing = []
+    ready = None
+    if not use_cache:
+        ready = fetcher.submit(prices.snapshot.refresh)
+    elif prices.snapshot.age() is None:
+        ready = fetcher.submit(
+            lambda: prices.snapshot.refresh(prices.snapshot.max_age))
+    for fiat in fiats:
+        def refprice(fiat=fiat):
+            if ready is not None:
+                ready.result()
+            return prices.snapshot.get(fiat)
+        for exchange in exchanges:
+            key = (exchange, fiat)
+            cached = cache.books.get(key) if use_cache else None
+            if cached is not None:
+                metrics.registry.inc('cache_requests_total', cache='books', result='hit')
+                books[key] = cached
+                continue
+            if use_cache:
+                metrics.registry.inc('cache_requests_total', cache='books', result='miss')
+            if not cache.books.fetch_misses:
+                missing.append(key)
+                continue
+            futures[key] = flights.submit(
+                key, lambda key=key, refprice=refprice: _get_market(*key, refprice))
+
+    results, late = fetcher.gather(futures)
+    missing.extend(late)
+    for key, book in results.items():
+        if book is None:
+            missing.append(key)
+            continue
+        books[key] = book
+        cache.books.put(key, book)
+    refprices = {fiat: prices.snapshot.current(fiat) for fiat in fiats}
+    return refprices, books, missing
+
+
+def refresh_orders(fiats):
+    """Fetch the order books of every exchange and warm the cache
+
+    Args:
+        fiats (list): currencies to refresh
+
+    Returns:
+        tuple: (books, diffs) where books maps (exchange, fiat) to the book of
+            every exchange that answered and diffs maps (exchange, fiat,
+            direction) to the BookDiff against the previous refresh
+    """
+    logging.info("Refreshing order books: " + ', '.join(fiats))
+    refprices, books, missing = fetch_orders(fiats, EXCHANGES, use_cache=False)
+    return books, diff.differ.update_books(books)
+
+
+def query_offers(fiat, direction, exchanges):
+    """Get the offers of one market from every exchange, without premium limit
+
+    The exchanges are queried concurrently, so a query takes as long as the
+    slowest exchange, bounded by config.EXCHANGE_DEADLINE. Books kept warm by
+    refresh_orders are answered from memory.
+
+    Args:
+        fiat (string): usd, eur, ...
+        direction (string): 'buy' or 'sell'
+        exchanges (string): exchange name, or 'all'
+
+    Returns:
+        tuple: (price, offers, missing) where offers are merged in display
+            order without the avoided methods and missing lists the exchanges
+            that did not answer in time
+    """
+    logging.info('Exchanges: ' + exchanges)
+    if exchanges == "all":
+        names = EXCHANGES
+    else:
+        names = [exchanges]
+    refprices, books, missing = fetch_orders([fiat], names)
+    missing = [key[0] for key in missing]
+    streams = [books[(name, fiat)][direction] for name in names if (name, fiat) in books]
+    return refprices.get(fiat), pipeline.select_offers(streams, direction, 'alloffers'), missing
+
+
+def offers_table(offers):
+    """Render offers as a table split in pages that fit in a Telegram message
+
+    Returns:
+        list: pages of the table
+    """
+    with metrics.registry.timer('render_seconds', kind='table'):
+        table = TableBuilder(
+            ['Exchange', 'Price', 'Dif', 'Min', 'Max', 'Method'], config.TABLE_PAGE_LENGTH)
+        for offer in offers:
+            table.add_row([f"{offer.exchange:10}", f"{offer.price:8n}", f"{offer.dif:4.1f}%",
+                           f"{offer.min_amount:7n}", f"{offer.max_amount:7n}", f"{offer.method}"])
+        return table.pages()
 
 
 def print_orders(fiat, direction, limit, exchanges):
@@ -35,79 +187,69 @@ def print_orders(fiat, direction, limit, exchanges):
         direction (string): 'buy' or 'sell'
         limit (int): percentage of premium
         exchanges (list): exchanges to query
+
+    Returns:
+        tuple: (price, pages, missing) where pages is the table of offers split
+            in pages that fit in a Telegram message and missing lists the
+            exchanges that did not answer in time
     """
-    logging.info('Exchanges: ' + exchanges)
-    session = get_tor_session()
-    price_exch = Bisq.getFiatPrice(fiat, session)
-    if exchanges == "all":
-        logging.info("Obtaining orders from bisq...")
-        bisqOffers = Bisq.getOffers(fiat, direction, price_exch, session)
-        logging.info("Obtaining orders from robosats...")
-        robosatsOffers = Robosats.getOffers(fiat, direction, session)
-        logging.info("Obtaining orders from hodlhodl...")
-        hodlhodlOffers = HodlHodl.getOffers(
-            fiat, direction, price_exch, session)
-        allOffers = bisqOffers + robosatsOffers + hodlhodlOffers
-    elif exchanges == "bisq":
-        logging.info("Obtaining orders from bisq...")
-        bisqOffers = Bisq.getOffers(fiat, direction, price_exch, session)
-        allOffers = bisqOffers
-    elif exchanges == "hodlhodl":
-        logging.info("Obtaining orders from hodlhodl...")
-        hodlhodlOffers = HodlHodl.getOffers(
-            fiat, direction, price_exch, session)
-        allOffers = hodlhodlOffers
-    elif exchanges == "robosats":
-        logging.info("Obtaining orders from robosats...")
-        robosatsOffers = Robosats.getOffers(fiat, direction, session)
-        allOffers = robosatsOffers
-    if direction == "buy":
-        allOffers.sort(key=lambda item: item.get('price'), reverse=True)
-    elif direction == "sell":
-        allOffers.sort(key=lambda item: item.get('price'))
-
-    table = pt.PrettyTable(
-        ['Exchange', 'Price', 'Dif', 'Min', 'Max', 'Method'])
-
-    for offer in allOffers:
-        if offer['method'].lower() not in config.avoid_methods:
-            row = [f"{offer['exchange']:10}", f"{offer['price']:8n}", f"{offer['dif']:4.1f}%",
-                   f"{offer['min_amount']:7n}", f"{offer['max_amount']:7n}", f"{offer['method']}"]
-            if limit == "alloffers":
-                table.add_row(row)
-            else:
-                if (direction == "buy") and (offer['dif'] > int(limit)):
-                    table.add_row(row)
-                if (direction == "sell") and (offer['dif'] < int(limit)):
-                    table.add_row(row)
-        # TODO: split the message in chunks so it won't exceed the max 4096 characters / msg
-        if len(table.get_string()) > 3800:
-            logger.info("limite de caracteres alcanzado")
-            break
+    price_exch, offers, missing = query_offers(fiat, direction, exchanges)
+    premium = pipeline.premium_filter(direction, limit)
+    if premium is not None:
+        offers = list(filter(premium, offers))
+    pages = offers_table(offers)
     logging.info("Done!")
-    return(price_exch, table)
+    return(price_exch, pages, missing)
+
+
+@lru_cache(maxsize=1)
+def _font():
+    """Monospace font used for images, loaded once"""
+    return ImageFont.truetype(FONT_PATH, FONT_SIZE)
+
+
+@lru_cache(maxsize=config.IMAGE_CACHE_SIZE)
+def _render_png(text):
+    fnt = _font()
+    ascent, descent = fnt.getmetrics()
+    line_height = ascent + descent + IMAGE_LINE_SPACING
+    char_width = fnt.getlength('M')
+    lines = text.split('\n')
+    # Monospace: the width follows from the number of columns, except for
+    # lines with glyphs of other widths (e.g. CJK translations)
+    text_width = max(len(line) * char_width if line.isascii() else fnt.getlength(line)
+                     for line in lines)
+    text_height = len(lines) * line_height - IMAGE_LINE_SPACING
+    img = Image.new('L', (int(text_width) + 2 * IMAGE_MARGIN,
+                          text_height + 2 * IMAGE_MARGIN), 255)
+    d = ImageDraw.Draw(img)
+    for i, line in enumerate(lines):
+        d.text(xy=(IMAGE_MARGIN, IMAGE_MARGIN + i * line_height),
+               text=line, font=fnt, fill=0)
+    s = io.BytesIO()
+    img.save(s, 'png')
+    return s.getvalue()
 
 
 def table_to_img(table):
     """Convert table to image
 
+    Rendered images are kept in a LRU cache, so the same table is only drawn
+    and encoded once.
+
     Args:
-        table (PrettyTable): Table to convert
+        table (string): Table to convert
 
     Returns:
-        Image: image
+        BytesIO: greyscale PNG image
     """
-    # Calculate dimensions of image from text
-    fnt = ImageFont.truetype("fonts/FreeMono.ttf", 15)
-    img = Image.new('RGB', (200, 100))
-    d = ImageDraw.Draw(img)
-    d.text((10, 10), table, font=fnt, fill=(255, 0, 0))
-    text_width, text_height = d.textsize(table, font=fnt)
-    # draw the actal image
-    img = Image.new('RGB', (text_width+20, text_height+20), (255, 255, 255))
-    d = ImageDraw.Draw(img)
-    d.text(xy=(10, 10), text=table, font=fnt, fill=(0, 0, 0))
-    s = io.BytesIO()
-    img.save(s, 'png')
-    s.seek(0)
-    return s
+    with metrics.registry.timer('render_seconds', kind='image'):
+        return io.BytesIO(_render_png(table))
+
+
+def _image_cache_info():
+    info = _render_png.cache_info()
+    return {(('result', 'hit'),): info.hits, (('result', 'miss'),): info.misses}
+
+
+metrics.registry.collect('image_cache_requests_total', _image_cache_info, 'counter')
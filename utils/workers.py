@@ -0,0 +1,82 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import config as config
+
+# Enable logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+ACCEPTED = 'accepted'
+DUPLICATE = 'duplicate'
+BUSY = 'busy'
+
+
+class QueryPool:
+    """Runs slow query work (exchange I/O, rendering) away from the dispatcher
+
+    The pool holds at most max_pending jobs, running or queued, and a single
+    job per key, so a user pressing "query" twice does not queue it twice.
+
+    Args:
+        workers (int): threads running queries
+        max_pending (int): jobs accepted at once, including the running ones
+    """
+
+    def __init__(self, workers, max_pending):
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='query')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._in_flight = set()
+        self._idle = threading.Condition()
+
+    def submit(self, key, job):
+        """Queue job unless key already has one in flight or the pool is full
+
+        Args:
+            key: identifies the requester, usually the chat id
+            job (callable): function without arguments
+
+        Returns:
+            string: ACCEPTED, DUPLICATE or BUSY
+        """
+        with self._idle:
+            if key in self._in_flight:
+                return DUPLICATE
+            if not self._slots.acquire(blocking=False):
+                return BUSY
+            self._in_flight.add(key)
+        self._executor.submit(self._run, key, job)
+        return ACCEPTED
+
+    def _run(self, key, job):
+        try:
+            job()
+        except Exception:
+            logger.exception("Query for %s failed" % key)
+        finally:
+            with self._idle:
+                self._in_flight.discard(key)
+                self._slots.release()
+                self._idle.notify_all()
+
+    def pending(self):
+        """Number of jobs running or queued"""
+        with self._idle:
+            return len(self._in_flight)
+
+    def join(self, timeout=None):
+        """Wait until every accepted job has finished
+
+        Returns:
+            bool: False if the timeout expired first
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._in_flight, timeout)
+
+
+# Shared by the query handlers
+queries = QueryPool(config.QUERY_WORKERS, config.QUERY_QUEUE_SIZE)